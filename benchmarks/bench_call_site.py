@@ -0,0 +1,36 @@
+"""Measure the cost of a log call with and without the call site cache of ExceptionLogger
+
+    python benchmarks/bench_call_site.py [number_of_records]
+"""
+import sys
+import time
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+import logger_tt
+from logger_tt.enhanced_class import ExceptionLogger
+
+
+def bench(logger: logging.Logger, n: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(n):
+        logger.info('This is log line number %d', i)
+    return time.perf_counter() - t0
+
+
+def main(n: int):
+    logger = ExceptionLogger('bench call site')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    print(f'{n} log calls to a NullHandler')
+    for size in [0, 1024]:
+        logger_tt.internal_config.call_site_cache_size = size
+        best = min(bench(logger, n) for _ in range(5))
+        name = f'call_site_cache_size={size}'
+        print(f'{name:<30} {best:7.3f}s   {n / best:12,.0f} records/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,60 @@
+"""Compare the cost per record of the stdlib rotating file handler and logger_tt ones
+
+    python benchmarks/bench_file_handlers.py [number_of_records]
+"""
+import sys
+import time
+import logging
+import tempfile
+from pathlib import Path
+from logging.handlers import TimedRotatingFileHandler
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.handlers import BufferedRotatingFileHandler, MMapFileHandler
+
+
+FORMAT = "[%(asctime)s] [%(name)s:%(lineno)d %(levelname)s] %(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+
+def make_records(n: int) -> list:
+    return [logging.LogRecord('bench', logging.INFO, __file__, 10, 'This is log line number %d', (i,), None)
+            for i in range(n)]
+
+
+def bench(name: str, make_handler, records: list, fmt: str, repeat: int = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        handler = make_handler()
+        handler.setFormatter(logging.Formatter(fmt, DATEFMT))
+        t0 = time.perf_counter()
+        for record in records:
+            handler.handle(record)
+        handler.close()
+        best = min(best, time.perf_counter() - t0)
+    print(f'{name:<45} {best:7.3f}s   {len(records) / best:12,.0f} records/s')
+
+
+def main(n: int):
+    records = make_records(n)
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        cases = {
+            'stdlib TimedRotatingFileHandler':
+                lambda: TimedRotatingFileHandler(folder / 'std.txt', when='midnight', backupCount=15, encoding='utf8'),
+            'BufferedRotatingFileHandler (time)':
+                lambda: BufferedRotatingFileHandler(folder / 'tt.txt', when='midnight', backupCount=15, encoding='utf8'),
+            'BufferedRotatingFileHandler (time + 10MB)':
+                lambda: BufferedRotatingFileHandler(folder / 'tt2.txt', when='midnight', maxBytes=10 * 1024 ** 2,
+                                                    backupCount=15, encoding='utf8'),
+            'MMapFileHandler (16MB segments)':
+                lambda: MMapFileHandler(folder / 'mm.txt', segment_size=16 * 1024 ** 2, backupCount=15),
+        }
+        for fmt in [FORMAT, '%(message)s']:
+            print(f'format: {fmt}')
+            for name, make_handler in cases.items():
+                bench(name, make_handler, records, fmt)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,77 @@
+"""Compare the cost per record of the stdlib formatter and DefaultFormatter,
+    which caches the asctime of the current second, with and without the compiled format strings
+
+    python benchmarks/bench_formatters.py [number_of_records]
+"""
+import sys
+import copy
+import time
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.enhanced_class import DefaultFormatter
+
+
+FORMATS = {
+    'simple': "[%(asctime)s] [%(name)s:%(lineno)d %(levelname)s] %(message)s",
+    'brief': "[%(asctime)s] %(levelname)s: %(message)s",
+}
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+
+def make_records(n: int, name: str) -> list:
+    return [logging.LogRecord(name, logging.INFO, __file__, 10, 'This is log line number %d', (i,), None)
+            for i in range(n)]
+
+
+def bench(formatter: logging.Formatter, records: list, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        batch = [copy.copy(x) for x in records]
+        t0 = time.perf_counter()
+        for record in batch:
+            formatter.format(record)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_fan_out(formatter: logging.Formatter, records: list, handlers: int, repeat: int = 5) -> float:
+    """The same record formatted by several handlers sharing the formatter"""
+    best = float('inf')
+    for _ in range(repeat):
+        batch = [copy.copy(x) for x in records]
+        t0 = time.perf_counter()
+        for record in batch:
+            for _ in range(handlers):
+                formatter.format(record)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(n: int):
+    for logger_name in ['app', 'logger_tt']:
+        records = make_records(n, logger_name)
+        print(f'{n} records of the "{logger_name}" logger')
+        for fmt_name, fmt in FORMATS.items():
+            for kind, formatter in [('logging.Formatter', logging.Formatter(fmt, DATEFMT)),
+                                    ('DefaultFormatter', DefaultFormatter(fmt, DATEFMT)),
+                                    ('DefaultFormatter, compiled', DefaultFormatter(fmt, DATEFMT, compiled=True))]:
+                if logger_name == 'logger_tt' and kind == 'logging.Formatter':
+                    continue
+                best = bench(formatter, records)
+                name = f'{fmt_name}, {kind}'
+                print(f'{name:<40} {best:7.3f}s   {n / best:12,.0f} records/s')
+        print()
+
+    records = make_records(n, 'app')
+    handlers = 3
+    print(f'{n} records of the "app" logger, each one to {handlers} handlers sharing the "simple" formatter')
+    for kind, formatter in [('logging.Formatter', logging.Formatter(FORMATS['simple'], DATEFMT)),
+                            ('DefaultFormatter', DefaultFormatter(FORMATS['simple'], DATEFMT))]:
+        best = bench_fan_out(formatter, records, handlers)
+        print(f'{kind:<40} {best:7.3f}s   {n / best:12,.0f} records/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,44 @@
+"""Measure debug calls that no handler takes, with the root logger at DEBUG and every handler at INFO or higher
+
+    python benchmarks/bench_handler_level.py [number_of_calls]
+"""
+import sys
+import json
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt import setup_logging
+
+
+def make_config(folder: str) -> str:
+    config = json.loads((Path(__file__).parents[1] / 'logger_tt/log_config.json').read_text())
+    config['handlers']['error_file_handler']['level'] = 'INFO'
+    config['handlers']['error_file_handler']['filename'] = f'{folder}/log.txt'
+    path = Path(folder) / 'log_config.json'
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+def bench(name: str, config_path: str, n: int, **kwargs):
+    with setup_logging(config_path=config_path, **kwargs):
+        logger = logging.getLogger('bench handler level')
+        t0 = time.perf_counter()
+        for i in range(n):
+            logger.debug('dropped %d', i)
+        total = time.perf_counter() - t0
+    print(f'{name:<35} {total:7.3f}s   {n / total:12,.0f} calls/s')
+
+
+def main(n: int):
+    with tempfile.TemporaryDirectory() as folder:
+        config_path = make_config(folder)
+        print(f'{n} debug calls, the handlers behind the queue take INFO and higher')
+        bench('logger level only', config_path, n)
+        bench('handler_level_filter=True', config_path, n, handler_level_filter=True)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,64 @@
+"""Compare the cost per record of DefaultFormatter text output and JsonFormatter with each encoder
+
+    python benchmarks/bench_json_formatter.py [number_of_records]
+"""
+import sys
+import copy
+import json
+import time
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.enhanced_class import DefaultFormatter, DefaultLogRecord, JsonFormatter, orjson
+
+SIMPLE = "[%(asctime)s] [%(name)s:%(lineno)d %(levelname)s] %(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+
+def make_records(n: int) -> list:
+    records = []
+    for i in range(n):
+        record = DefaultLogRecord('bench', logging.INFO, __file__, 10, 'This is log line number %d', (i,), None,
+                                  user='bob', attempt=i)
+        record.request_id = f'req-{i % 100}'  # as added by a context injector
+        records.append(record)
+    return records
+
+
+def naive_json(record: logging.LogRecord) -> str:
+    """Building the dict attribute by attribute and json.dumps with its default settings"""
+    fields = {'time': logging.Formatter.formatTime(logging.Formatter(), record, DATEFMT),
+              'level': record.levelname, 'logger': record.name, 'message': record.getMessage(),
+              'pathname': record.pathname, 'lineno': record.lineno, 'function': record.funcName,
+              'process': record.processName, 'thread': record.threadName, 'kwargs': record.kwargs,
+              'extra': {'request_id': record.request_id}}
+    return json.dumps(fields, default=str)
+
+
+def bench(name: str, format_record, records: list, repeat: int = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        batch = [copy.copy(x) for x in records]
+        t0 = time.perf_counter()
+        for record in batch:
+            format_record(record)
+        best = min(best, time.perf_counter() - t0)
+    print(f'{name:<35} {best:7.3f}s   {len(records) / best:12,.0f} records/s')
+
+
+def main(n: int):
+    records = make_records(n)
+    print(f'{n} records')
+    bench('DefaultFormatter, text', DefaultFormatter(SIMPLE, DATEFMT).format, records)
+    bench('DefaultFormatter, compiled text', DefaultFormatter(SIMPLE, DATEFMT, compiled=True).format, records)
+    bench('json.dumps per record', naive_json, records)
+    bench('JsonFormatter, json', JsonFormatter(datefmt=DATEFMT, encoder='json').format, records)
+    if orjson is None:
+        print('JsonFormatter, orjson: not installed')
+    else:
+        bench('JsonFormatter, orjson', JsonFormatter(datefmt=DATEFMT, encoder='orjson').format, records)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
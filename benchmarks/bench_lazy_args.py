@@ -0,0 +1,53 @@
+"""Compare an expensive argument computed at the log call with the same argument wrapped by lazy()
+
+    python benchmarks/bench_lazy_args.py [number_of_records]
+"""
+import io
+import sys
+import json
+import time
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt import lazy
+from logger_tt.enhanced_class import DefaultFormatter
+
+STATE = {f'key{i}': {'values': list(range(10)), 'name': f'item {i}'} for i in range(20)}
+
+
+def make_logger() -> logging.Logger:
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(DefaultFormatter('{levelname}: {message}', style='{'))
+    logger = logging.getLogger('bench lazy args')
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+def bench(name: str, log, n: int, repeat: int = 3):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            log()
+        best = min(best, time.perf_counter() - t0)
+    print(f'{name:<35} {best:7.3f}s   {n / best:12,.0f} calls/s')
+
+
+def main(n: int):
+    logger = make_logger()
+    print(f'{n} log calls with a json dump of {len(STATE)} items, dropped by the handler level')
+    bench('computed at the call', lambda: logger.debug('state: {state}', state=json.dumps(STATE)), n)
+    bench('lazy()', lambda: logger.debug('state: {state}', state=lazy(json.dumps, STATE)), n)
+
+    print(f'\n{n} log calls, formatted')
+    bench('computed at the call', lambda: logger.info('state: {state}', state=json.dumps(STATE)), n)
+    bench('lazy()', lambda: logger.info('state: {state}', state=lazy(json.dumps, STATE)), n)
+    bench('no expensive argument', lambda: logger.info('state: {state}', state='ok'), n)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,55 @@
+"""Compare the cost of getMessage for each message style, with a few thousand distinct messages
+
+    python benchmarks/bench_message_styles.py [number_of_records]
+"""
+import sys
+import time
+from pathlib import Path
+from string import Template
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.enhanced_class import DefaultLogRecord, parse_template
+
+TEMPLATES = 2000
+MESSAGES = {
+    '%': ('Task {i}: user %s did %s on %s', ('bob', 'delete', 'file.txt'), {}),
+    '{': ('Task {i}: user {{user}} did {{action}} on {{}}', ('file.txt',), {'user': 'bob', 'action': 'delete'}),
+    '$': ('Task {i}: user ${{user}} did $action on $item', (), {'user': 'bob', 'action': 'delete', 'item': 'file.txt'}),
+}
+
+
+def make_records(n: int, style: str) -> list:
+    msg, args, kwargs = MESSAGES[style]
+    templates = [msg.format(i=i) for i in range(TEMPLATES)]
+    return [DefaultLogRecord('bench', 20, __file__, 10, templates[i % TEMPLATES], args, None, **kwargs)
+            for i in range(n)]
+
+
+def get_message_dollar_uncached(record):
+    """The former way: a new string.Template for every record"""
+    return Template(str(record.msg)).substitute(record.kwargs)
+
+
+def bench(name: str, get_message, records: list, repeat: int = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for record in records:
+            get_message(record)
+        best = min(best, time.perf_counter() - t0)
+    print(f'{name:<35} {best:7.3f}s   {len(records) / best:12,.0f} messages/s')
+
+
+def main(n: int):
+    print(f'{n} records, {TEMPLATES} distinct messages')
+    bench('%, msg % args', DefaultLogRecord.get_message_percent, make_records(n, '%'))
+    bench('{, str.format', DefaultLogRecord.get_message_brace, make_records(n, '{'))
+    records = make_records(n, '$')
+    bench('$, string.Template per record', get_message_dollar_uncached, records)
+    parse_template.cache_clear()
+    bench('$, cached parsed templates', DefaultLogRecord.get_message_dollar, records)
+    print(parse_template.cache_info())
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
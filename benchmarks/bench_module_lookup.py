@@ -0,0 +1,61 @@
+"""Measure how the default logger finds the module name of the caller with many loaded modules
+
+    python benchmarks/bench_module_lookup.py [number_of_records]
+"""
+import sys
+import time
+import types
+import logging
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.enhanced_class import ExceptionLogger, ModuleIndex
+
+
+def load_modules(n: int):
+    for i in range(n):
+        module = types.ModuleType(f'bench_package.module_{i}')
+        module.__file__ = f'/site-packages/bench_package/module_{i}.py'
+        sys.modules[module.__name__] = module
+
+
+def scan(pathname: str, cache: dict):
+    """The former way: a full scan of sys.modules when the path is not cached yet"""
+    qualified_name = cache.get(pathname)
+    if not qualified_name:
+        for qualified_name, module in sys.modules.items():
+            file = getattr(module, '__file__', None)
+            if file and file.replace('\\', '/') == pathname:
+                cache[pathname] = qualified_name
+                break
+    return qualified_name
+
+
+def bench(name: str, lookup, pathname: str, n: int):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        lookup(pathname)
+    total = time.perf_counter() - t0
+    print(f'{name:<45} {total:7.3f}s   {n / total:12,.0f} lookups/s')
+
+
+def main(n: int):
+    load_modules(3000)
+    print(f'{len(sys.modules)} loaded modules, {n} lookups')
+    found = '/site-packages/bench_package/module_1500.py'
+    missing = '<exec script>'
+    for case, pathname in [('module', found), ('no module', missing)]:
+        bench(f'{case}, sys.modules scan', lambda x, cache={}: scan(x, cache), pathname, n)
+        bench(f'{case}, ModuleIndex', ModuleIndex().get, pathname, n)
+
+    logger = ExceptionLogger('logger_tt')
+    logger.msg_kwargs = {}
+    t0 = time.perf_counter()
+    for _ in range(n):
+        logger.makeRecord('logger_tt', logging.INFO, missing, 1, 'message', (), None)
+    total = time.perf_counter() - t0
+    print(f'{"makeRecord, no module":<45} {total:7.3f}s   {n / total:12,.0f} records/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,97 @@
+"""Compare sending the records of spawned processes to the log server
+    with writing them directly to the log file by AppendFileHandler
+
+    python benchmarks/bench_multiprocess_logging.py [number_of_processes] [records_per_process]
+"""
+import os
+import json
+import sys
+import time
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt import setup_logging, getLogger
+
+
+logger = getLogger('bench')
+
+
+def make_config(folder: Path, handler_class: str, **handler_kwargs) -> Path:
+    config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"simple": {"format": "[%(asctime)s] [%(name)s:%(lineno)d %(levelname)s] %(message)s",
+                                  "datefmt": "%Y-%m-%d %H:%M:%S"}},
+        "handlers": {"file": {"class": handler_class, "level": "DEBUG", "formatter": "simple",
+                              "filename": str(folder / 'log.txt'), "encoding": "utf8", **handler_kwargs}},
+        "loggers": {},
+        "root": {"level": "DEBUG", "handlers": ["file"]},
+        "logger_tt": {"use_multiprocessing": True, "port": 0, "server_timeout": 1},
+    }
+    config_file = folder / "config.json"
+    config_file.write_text(json.dumps(config))
+    return config_file
+
+
+def worker(n: int):
+    for i in range(n):
+        logger.info(f'This is log line number {i}')
+
+
+def run_main(config_file: str, proc_no: int, records: int):
+    """Executed in a new interpreter"""
+    setup_logging(config_path=config_file)
+    log_file = Path(config_file).parent / 'log.txt'
+    expected = proc_no * records
+
+    t0 = time.perf_counter()
+    processes = [multiprocessing.Process(target=worker, args=(records,)) for _ in range(proc_no)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    # wait until all records are in the file
+    count = 0
+    while not log_file.exists():
+        time.sleep(0.05)
+    with log_file.open('rb') as f:
+        while count < expected:
+            data = f.read()
+            count += data.count(b'This is log line')
+            if not data:
+                time.sleep(0.05)
+    dt = time.perf_counter() - t0
+    print(f'{dt:.3f}')
+
+
+def main(proc_no: int, records: int):
+    cases = {'socket to server (TimedRotatingFileHandler)': ('logging.handlers.TimedRotatingFileHandler', {}),
+             'AppendFileHandler, every record': ('logger_tt.handlers.AppendFileHandler', {}),
+             'AppendFileHandler, batched up to PIPE_BUF': ('logger_tt.handlers.AppendFileHandler',
+                                                           {"buffer_time": 0.2, "buffer_lines": 0}),
+             }
+
+    print(f'{proc_no} spawned processes x {records} records, {os.cpu_count()} CPUs')
+    for name, (handler_class, handler_kwargs) in cases.items():
+        with tempfile.TemporaryDirectory() as folder:
+            config_file = make_config(Path(folder), handler_class, **handler_kwargs)
+            cmd = [sys.executable, __file__, 'run', str(config_file), str(proc_no), str(records)]
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, cwd=folder)
+            dt = float(result.stdout.strip().splitlines()[-1])
+            print(f'{name:<45} {dt:7.3f}s   {proc_no * records / dt:12,.0f} records/s')
+
+
+if len(sys.argv) > 1 and sys.argv[1] == 'run':
+    # spawned children import this module again, so setup_logging must be called at import time
+    setup_logging(config_path=sys.argv[2])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        multiprocessing.set_start_method('spawn')
+        run_main(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(*(int(x) for x in sys.argv[1:3])) if len(sys.argv) > 2 else main(8, 20000)
@@ -0,0 +1,137 @@
+"""Measure the delivery throughput of TelegramHandler against a local stand-in of the Bot API
+
+    python benchmarks/bench_telegram_delivery.py [number_of_records]
+"""
+import sys
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from urllib import request, parse
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.handlers import TelegramHandler
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep the connection alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _reply(self):
+        self.server.requests += 1
+        data = json.dumps({'ok': True}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.latency)
+        self._reply()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInBotApi(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+def make_records(n: int) -> list:
+    return [logging.LogRecord('bench', logging.ERROR, __file__, 10, 'Something failed, attempt %d', (i,), None)
+            for i in range(n)]
+
+
+def bench_urlopen(server: StandInBotApi, records: list):
+    """The former way: one new connection and one GET request with the text in the url per message"""
+    formatter = logging.Formatter('%(levelname)s: %(message)s')
+    t0 = time.perf_counter()
+    for record in records:
+        params = parse.urlencode({'chat_id': '123456789', 'text': formatter.format(record)})
+        with request.urlopen(f'{server.url}/bot123:abc/sendMessage?{params}') as f:
+            f.read()
+    return time.perf_counter() - t0, time.perf_counter() - t0
+
+
+def bench_handler(server: StandInBotApi, records: list):
+    # no rate limits nor aggregation, measure the delivery itself
+    handler = TelegramHandler(token='123:abc', unique_ids='123456789', base_url=server.url,
+                              queue_size=len(records), rate_limit=0, chat_rate_limit=0, aggregate_window=0)
+    handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    t0 = time.perf_counter()
+    for record in records:
+        handler.handle(record)
+    emit_time = time.perf_counter() - t0
+    handler.flush()
+    total = time.perf_counter() - t0
+    handler.close()
+    return emit_time, total
+
+
+def bench_fan_out(records: list, destinations: int, latency: float):
+    """Several destinations behind a slow API, one after another vs at the same time"""
+    unique_ids = '; '.join(str(1000 + i) for i in range(destinations))
+    for max_workers in [1, 4]:
+        server = StandInBotApi(latency)
+        handler = TelegramHandler(token='123:abc', unique_ids=unique_ids, base_url=server.url,
+                                  queue_size=len(records), rate_limit=0, chat_rate_limit=0, max_workers=max_workers,
+                                  aggregate_window=0)
+        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+        t0 = time.perf_counter()
+        for record in records:
+            handler.handle(record)
+        handler.flush()
+        total = time.perf_counter() - t0
+        handler.close()
+
+        stats = handler.delivery_stats['1000']
+        name = f'max_workers={max_workers}'
+        print(f'{name:<35} delivered: {total:7.3f}s {server.requests / total:10,.0f} msg/s   '
+              f'latency of one destination: avg {stats.avg * 1000:.1f}ms, max {stats.max * 1000:.1f}ms')
+        server.shutdown()
+        server.server_close()
+
+
+def main(n: int):
+    records = make_records(n)
+    print(f'{n} records to a local stand-in server')
+    for name, bench in [('urlopen per message', bench_urlopen),
+                        ('TelegramHandler, kept-alive POST', bench_handler)]:
+        server = StandInBotApi()
+        emit_time, total = bench(server, records)
+        print(f'{name:<35} logging thread: {emit_time:7.3f}s   delivered: {total:7.3f}s '
+              f'{server.requests / total:10,.0f} msg/s   connections: {server.connections}')
+        server.shutdown()
+        server.server_close()
+
+    destinations, latency = 5, 0.02
+    records = make_records(min(n, 20))   # sent one after another within the flush timeout
+    print(f'\n{len(records)} records to {destinations} destinations, {latency * 1000:.0f}ms API latency')
+    bench_fan_out(records, destinations, latency)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,106 @@
+"""Measure the delivery throughput of WebhookHandler against a local http.server stand-in of a log collector
+
+    python benchmarks/bench_webhook_delivery.py [number_of_records]
+"""
+import sys
+import gzip
+import time
+import logging
+import threading
+import logging.handlers
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+from logger_tt.handlers import WebhookHandler
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep the connection alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        self.server.bytes += len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInCollector(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self.bytes = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/logs'
+
+
+def make_records(n: int) -> list:
+    return [logging.LogRecord('bench', logging.ERROR, __file__, 10, 'Something failed, attempt %d', (i,), None)
+            for i in range(n)]
+
+
+def bench_http_handler(server: StandInCollector, records: list):
+    """The stdlib way: one new connection and one form-encoded POST per record, in the logging thread"""
+    handler = logging.handlers.HTTPHandler(f'127.0.0.1:{server.server_port}', '/logs', method='POST')
+    t0 = time.perf_counter()
+    for record in records:
+        handler.handle(record)
+    total = time.perf_counter() - t0
+    handler.close()
+    return total, total
+
+
+def bench_webhook(server: StandInCollector, records: list, **kwargs):
+    handler = WebhookHandler(url=server.url, queue_size=len(records), **kwargs)
+    handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    t0 = time.perf_counter()
+    for record in records:
+        handler.handle(record)
+    emit_time = time.perf_counter() - t0
+    handler.flush()
+    total = time.perf_counter() - t0
+    handler.close()
+    return emit_time, total
+
+
+def main(n: int):
+    records = make_records(n)
+    for latency in [0, 0.005]:
+        print(f'{n} records to a local stand-in collector, {latency * 1000:.0f}ms latency')
+        for name, bench in [('stdlib HTTPHandler', bench_http_handler),
+                            ('WebhookHandler, batch 100', lambda s, r: bench_webhook(s, r, compress=False)),
+                            ('WebhookHandler, batch 100, gzip', bench_webhook)]:
+            server = StandInCollector(latency)
+            emit_time, total = bench(server, records)
+            print(f'{name:<35} logging thread: {emit_time:7.3f}s   delivered: {total:7.3f}s '
+                  f'{n / total:10,.0f} records/s   requests: {server.requests:5}   '
+                  f'connections: {server.connections:5}   sent: {server.bytes / 1024:8.1f}KiB')
+            server.shutdown()
+            server.server_close()
+        print()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
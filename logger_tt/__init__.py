@@ -1,4 +1,5 @@
 import json
+import os
 import logging
 import sys
 import threading
@@ -7,12 +8,12 @@ from logging.config import dictConfig
 from pathlib import Path
 from typing import *
 
-from .enhanced_class import ExceptionLogger, DefaultLogRecord, DefaultFormatter
+from .enhanced_class import ExceptionLogger, DefaultLogRecord, DefaultFormatter, lazy
 from .core import LogConfig, in_main_process
 from .inspector import analyze_exception_recur, logging_disabled
 
 __author__ = "Duc Tin"
-__all__ = ['setup_logging', 'logging_disabled', 'getLogger', 'logger']
+__all__ = ['setup_logging', 'logging_disabled', 'getLogger', 'logger', 'lazy']
 
 """Config log from file and make it also logs uncaught exception"""
 
@@ -35,7 +36,7 @@ def handle_exception(exc_type, exc_value, exc_traceback, thread_name=''):
     if thread_name:
         thread_name = ' in ' + thread_name
 
-    logging.error(f"Uncaught exception{thread_name}:\n{txt}")
+    logging.error(f"Uncaught exception{thread_name}:\n{txt}", extra={'exc_analysis': txt})
 
     if not thread_name:
         # As interpreter is going to shutdown after this function,
@@ -81,6 +82,28 @@ def ensure_path(config: Dict[str, Dict[str, dict]], override_log_paths: Union[st
         log_path.mkdir(parents=True, exist_ok=True)
 
 
+def keep_multiprocess_safe_handlers(config: dict) -> list:
+    """In a child process, find the root's handlers that this process can write to directly.
+        Their filename is replaced by the one that the parent process is using.
+    """
+    configurator = logging.config.BaseConfigurator({})
+    parent_pid = os.getppid()
+    names = []
+    for name in config['root'].get('handlers', []):
+        handler = config['handlers'][name]
+        try:
+            klass = configurator.resolve(handler.get('class', ''))
+        except (ValueError, ImportError):
+            continue
+
+        if getattr(klass, 'multiprocess_safe', False):
+            filename = os.environ.get(internal_config.env_file_var.format(parent_pid, name))
+            handler['filename'] = filename or handler['filename']
+            names.append(name)
+
+    return names
+
+
 def load_from_file(f: Path) -> dict:
     if f.suffix in ['.yaml', '.yml']:
         try:
@@ -107,7 +130,7 @@ def load_from_file(f: Path) -> dict:
         dlf = {}
     DefaultFormatter.default_formats.update(dlf)
     for formatter in dict_cfg['formatters'].values():
-        if not formatter.get('class'):
+        if not formatter.get('class') and '()' not in formatter:
             formatter['class'] = 'logger_tt.enhanced_class.DefaultFormatter'
 
     return dict_cfg
@@ -122,6 +145,8 @@ def merge_config(from_file: dict, from_func: dict) -> dict:
                     suppress_level_below=logging.WARNING, use_multiprocessing=False,
                     limit_line_length=1000, analyze_raise_statement=False,
                     host=None, port=None, server_timeout=5, client_only=False,
+                    call_site_cache_size=1024, handler_level_filter=False,
+                    compiled_format=False,
                     )
     merged = {}
     for key, val in defaults.items():
@@ -200,6 +225,13 @@ def setup_logging(config_path: str = "", log_path: str = "", **logger_tt_config)
                         through socket. Used in multiprocessing logging
         :key client_only: bool, default to False. True to not starting the listener server.
                         Use in case of multiple applications that want to log to a central destination.
+        :key call_site_cache_size: int, default to 1024. Number of logging call sites whose caller info
+                        (file, line, function) is cached instead of walking the stack for every record. 0: disabled
+        :key handler_level_filter: bool, default to False. True to also reject, before a record is made,
+                        the levels that none of the handlers of a logger takes, including the handlers
+                        behind the queue and the log server.
+        :key compiled_format: bool, default to False. True to turn the format strings of the formatters
+                        into functions that read the record attributes directly.
     """
 
     config, cfgpath = _get_config(config_path)
@@ -210,7 +242,9 @@ def setup_logging(config_path: str = "", log_path: str = "", **logger_tt_config)
     else:
         # child process of Spawn-method
         del config['loggers']           # remove all loggers as they will not be used
-        del config['root']['handlers']  # remove all handlers of the root logger as a socket handler will be added later
+        # remove all handlers of the root logger as a socket handler will be added later
+        # except the ones that this process can write to directly
+        config['root']['handlers'] = keep_multiprocess_safe_handlers(config)
 
     try:
         if internal_config.initialized:
@@ -219,6 +253,12 @@ def setup_logging(config_path: str = "", log_path: str = "", **logger_tt_config)
             # add NOTICE level for telegram handler
             internal_config.add_logging_level('NOTICE', logging.INFO + 5)
 
+        # merge config from config file and function arguments
+        iconfig = merge_config(logger_tt_cfg, logger_tt_config)
+
+        # the formatters are created by dictConfig
+        DefaultFormatter.compiled = bool(iconfig['compiled_format'])
+
         # initialize
         for name in logging.root.manager.loggerDict:
             existing_logger = logging.getLogger(name)
@@ -226,8 +266,6 @@ def setup_logging(config_path: str = "", log_path: str = "", **logger_tt_config)
         else:
             logging.config.dictConfig(config)
 
-        # merge config from config file and function arguments
-        iconfig = merge_config(logger_tt_cfg, logger_tt_config)
         is_mp_client = iconfig['use_multiprocessing'] and iconfig['client_only']
 
         if in_main_process() and not is_mp_client:
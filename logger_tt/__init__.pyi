@@ -4,10 +4,11 @@ from typing import Union
 from logging import getLogger
 from .inspector import logging_disabled
 from .core import LogConfig
+from .enhanced_class import lazy
 
 
 __author__ = "Duc Tin"
-__all__ = ['setup_logging', 'logging_disabled', 'getLogger', 'logger']
+__all__ = ['setup_logging', 'logging_disabled', 'getLogger', 'logger', 'lazy']
 
 
 logger: logging.Logger
@@ -26,4 +27,7 @@ def setup_logging(config_path: str = "", log_path: str = "",
                   host: str = None,
                   port: int = None,
                   server_timeout: float = 5,
-                  client_only: bool = False) -> LogConfig: ...
+                  client_only: bool = False,
+                  call_site_cache_size: int = 1024,
+                  handler_level_filter: bool = False,
+                  compiled_format: bool = False) -> LogConfig: ...
@@ -43,6 +43,22 @@ def temporary_logger(logger, temp_handlers: list):
         logger.handlers = org_handlers
 
 
+class QueueHandlerWithLevel(handlers.QueueHandler):
+    """A queue handler that doesn't queue the records that none of the handlers behind the queue takes.
+        The listener would drop them anyway, but `prepare` formats every record it queues,
+        which also computes the `lazy` arguments of the message.
+    """
+
+    def __init__(self, queue, behind: tuple = ()):
+        super().__init__(queue)
+        self.behind = behind
+
+    def emit(self, record):
+        if all(record.levelno < h.level for h in self.behind):
+            return
+        super().emit(record)
+
+
 class LogConfig:
     def __init__(self):
         self.qclass = None
@@ -54,6 +70,8 @@ class LogConfig:
         self._port = handlers.DEFAULT_TCP_LOGGING_PORT
         self.tcp_server = None
         self.env_port_var = 'logger_tt_{}'
+        self.env_file_var = 'logger_tt_{}_{}'
+        self.env_level_var = 'logger_tt_level_{}'
 
         # other settings
         self.full_context = False
@@ -64,6 +82,8 @@ class LogConfig:
         self.limit_line_length = 1000
         self.analyze_raise_statement = False
         self.server_timeout = 5
+        self.call_site_cache_size = 1024
+        self.__handler_level_filter = False
         self.original_stdout = sys.stdout
 
         # suppress logger list for usage in filter
@@ -75,6 +95,9 @@ class LogConfig:
         # use context injector
         self.__middle_handlers = []
 
+        # middle handler: the handlers behind it, or their lowest level if they are in the parent process
+        self.__behind_handlers = {}
+
         # track added logging level to undo later
         self.__added_logging_level = {}
 
@@ -93,6 +116,9 @@ class LogConfig:
         # set limit_line_length
         self.limit_line_length = max(0, int(odict['limit_line_length']))
 
+        # number of logging call sites whose caller info is cached, 0: disabled
+        self.call_site_cache_size = max(0, int(odict['call_site_cache_size']))
+
         # suppress other logger
         level = odict.get('suppress_level_below', 'WARNING')
         if type(level) is str:
@@ -113,6 +139,9 @@ class LogConfig:
         # set logging mode accordingly
         self._set_mode(odict['use_multiprocessing'], odict['client_only'])
 
+        # reject the levels that no handler takes before a record is made
+        self.handler_level_filter = odict['handler_level_filter']
+
         self.__initialized += 1
 
     def _set_mode(self, use_multiprocessing, client_only: bool):
@@ -145,16 +174,21 @@ class LogConfig:
                 continue
 
             # backup current handlers then clear it
+            # with a multiprocessing queue, forked children can write to multiprocess_safe handlers directly
             all_handlers = logger.handlers
-            logger.handlers = []
+            if self.qclass is mpQueue:
+                logger.handlers = [h for h in all_handlers if getattr(h, 'multiprocess_safe', False)]
+                all_handlers = [h for h in all_handlers if h not in logger.handlers]
+            else:
+                logger.handlers = []
 
             # add queue handler
             queue = self.qclass()
-            q_handler = handlers.QueueHandler(queue)
+            ql = handlers.QueueListener(queue, *all_handlers, respect_handler_level=True)
+            q_handler = QueueHandlerWithLevel(queue, ql.handlers)
             logger.addHandler(q_handler)
             self.__middle_handlers.append(q_handler)
-
-            ql = handlers.QueueListener(queue, *all_handlers, respect_handler_level=True)
+            self.__behind_handlers[q_handler] = ql.handlers
             self.q_listeners.append(ql)
 
             # start listening
@@ -166,12 +200,26 @@ class LogConfig:
     def _replace_with_socket_handler(self, client_only: bool):
         """ setup a central socket handler and start a listener server """
 
+        # handlers that every process writes to directly, not through the server
+        direct_handlers = [h for h in root_logger.handlers if getattr(h, 'multiprocess_safe', False)]
+
         # initiate server
         if in_main_process():
-            if not client_only:
-                # backup current handlers
-                all_handlers = root_logger.handlers
+            pid = current_process().pid
+
+            # child processes must write to the same files
+            for handler in direct_handlers:
+                os.environ[self.env_file_var.format(pid, handler.name)] = handler.baseFilename
 
+            # backup current handlers
+            all_handlers = [h for h in root_logger.handlers if h not in direct_handlers]
+            if direct_handlers and not all_handlers and not client_only:
+                # every process writes to the log files itself, no server is needed
+                os.environ[self.env_port_var.format(pid)] = ''
+                root_logger.debug('All handlers are multiprocess safe, logging server is not started')
+                return
+
+            if not client_only:
                 self.tcp_server = LogRecordSocketReceiver(self._host, self._port, all_handlers, self.server_timeout)
                 serving = Thread(target=self.tcp_server.serve_until_stopped)
                 serving.start()
@@ -180,8 +228,9 @@ class LogConfig:
                 self._port = port   # get the real port number in case user used "0"
 
                 # set environ variable for child processes
-                pid = current_process().pid
                 os.environ[self.env_port_var.format(pid)] = str(port)
+                if all_handlers:
+                    os.environ[self.env_level_var.format(pid)] = str(min(h.level for h in all_handlers))
 
                 # log info
                 root_logger.debug('Logging server started!')
@@ -189,15 +238,25 @@ class LogConfig:
 
             # add socket handler
             socket_handler = logging.handlers.SocketHandler(self._host, self._port)
-            root_logger.handlers = []
+            root_logger.handlers = direct_handlers
             root_logger.addHandler(socket_handler)
+            if not client_only:
+                self.__behind_handlers[socket_handler] = all_handlers
         else:
-            # add socket handler
             parent_pid = os.getppid()
             port = os.environ.get(self.env_port_var.format(parent_pid), self._port)
+            if port == '':
+                # the parent has no logging server, write to the files directly only
+                root_logger.handlers = direct_handlers
+                return
+
+            # add socket handler
             socket_handler = logging.handlers.SocketHandler(self._host, int(port))
-            root_logger.handlers = []
+            root_logger.handlers = direct_handlers
             root_logger.addHandler(socket_handler)
+            level = os.environ.get(self.env_level_var.format(parent_pid))
+            if level:
+                self.__behind_handlers[socket_handler] = int(level)
             root_logger.debug(f'Child picked up port: {port}')
 
         atexit.register(socket_handler.close)
@@ -241,6 +300,44 @@ class LogConfig:
         else:
             sys.stdout = self.original_stdout
 
+    @property
+    def handler_level_filter(self):
+        return self.__handler_level_filter
+
+    @handler_level_filter.setter
+    def handler_level_filter(self, val):
+        self.__handler_level_filter = bool(val)
+        self.refresh_handler_levels()
+
+    def refresh_handler_levels(self):
+        """Forget the levels that the loggers have found enabled or not.
+            Call it after changing the level of a handler or the handlers of a logger on the fly,
+            changing the level of a logger already does it.
+        """
+        if hasattr(root_logger.manager, '_clear_cache'):
+            root_logger.manager._clear_cache()
+
+    def handler_level(self, logger: logging.Logger) -> int:
+        """The lowest level that a handler of this logger or of its parents takes.
+            For the queue and socket handlers of logger_tt, the handlers behind them are checked.
+        """
+        levels = []
+        while logger:
+            for handler in logger.handlers:
+                behind = self.__behind_handlers.get(handler)
+                if isinstance(behind, int):
+                    levels.append(max(handler.level, behind))
+                elif behind:
+                    levels.append(max(handler.level, min(h.level for h in behind)))
+                else:
+                    levels.append(handler.level)
+            if not logger.propagate:
+                break
+            logger = logger.parent
+
+        # without any handler, logging.lastResort decides
+        return min(levels, default=logging.NOTSET)
+
     def set_context_injector(self, injector):
         for handler in self.__middle_handlers:
             handler.addFilter(injector)
@@ -309,6 +406,9 @@ class LogConfig:
         for custom_level in list(self.__added_logging_level):
             self.remove_logging_level(custom_level)
 
+        self.__behind_handlers.clear()
+        self.refresh_handler_levels()
+
         self.__initialized = False
 
 
@@ -1,14 +1,65 @@
 import re
 import sys
+import json
+import time
 import logging
+import weakref
+import threading
+from collections.abc import Mapping
+from functools import lru_cache
+from operator import attrgetter
 from .inspector import analyze_exception_recur
-from string import Template
+from string import Template, Formatter
+
+try:
+    import orjson
+except ImportError:
+    # the standard json module is used instead
+    orjson = None
 
 __author__ = "Duc Tin"
 
 PY_VER = sys.version_info.major, sys.version_info.minor
 
 
+class ModuleIndex:
+    """Find the qualified name of a loaded module by its file path.
+        The index is updated with the modules imported since the last lookup, only when a path is not found.
+        A path that matches no module is remembered too, until more modules are imported.
+    """
+
+    def __init__(self):
+        self._names = {}        # normalized path: qualified name, or None if no module has this path
+        self._indexed = set()   # names of the modules in the index
+        self._size = 0          # len(sys.modules) at the last update
+        self._lock = threading.Lock()
+
+    def get(self, pathname: str):
+        """Return the qualified name of the module of this path, or None"""
+        name = self._names.get(pathname, self)
+        if name is self or (name is None and len(sys.modules) != self._size):
+            with self._lock:
+                self._update()
+                name = self._names.setdefault(pathname, None)
+        return name
+
+    def _update(self):
+        # copy, as another thread may import a module at the same time
+        modules = list(sys.modules.items())
+        for qualified_name, module in modules:
+            if qualified_name in self._indexed:
+                continue
+
+            self._indexed.add(qualified_name)
+            file = getattr(module, '__file__', None)
+            if file:
+                # the first module of a path wins, as __main__ is before the others
+                file = file.replace('\\', '/')
+                if self._names.get(file) is None:
+                    self._names[file] = qualified_name
+        self._size = len(modules)
+
+
 class ExceptionLogger(logging.Logger):
     """Modify the `exception` func so that it print out context too
         This allows user do a try-except in outer code but still has the full log
@@ -21,7 +72,7 @@ class ExceptionLogger(logging.Logger):
             # then move on
     """
 
-    _logger_names = {}
+    _module_index = ModuleIndex()
     config = None
 
     def exception(self, msg, *args, exc_info=True, **kwargs):
@@ -31,24 +82,71 @@ class ExceptionLogger(logging.Logger):
             limit_length = self.config.limit_line_length
             analyze_raise = self.config.analyze_raise_statement
             txt = analyze_exception_recur(exc_value, full_context, limit_length, analyze_raise)
-            logging.error(f'{msg}\n{txt}')
+            logging.error(f'{msg}\n{txt}', extra={'exc_analysis': txt})
         else:
             logging.error(msg, *args, exc_info=exc_info, **kwargs)
 
+    # the frame walk of findCaller is the same in all versions since Python 3.11
+    if hasattr(logging, '_is_internal_frame'):
+        _call_sites = {}        # (code object, instruction offset): (pathname, lineno, funcName, None)
+        _internal_codes = {}    # code object: whether its frames belong to the logging module
+
+        def findCaller(self, stack_info=False, stacklevel=1):
+            """Same as logging.Logger.findCaller, but each frame is checked once per code object
+                and the caller info of a call site is computed only once
+            """
+            size = self.config.call_site_cache_size if self.config else 0
+            if stack_info or not size:
+                # one more level for this override
+                return super().findCaller(stack_info, stacklevel + 1)
+
+            internal_codes = self._internal_codes
+            f = sys._getframe()
+            while stacklevel > 0:
+                next_f = f.f_back
+                if next_f is None:
+                    break
+                f = next_f
+                internal = internal_codes.get(f.f_code)
+                if internal is None:
+                    if len(internal_codes) >= size:
+                        internal_codes.clear()
+                    internal = internal_codes[f.f_code] = logging._is_internal_frame(f)
+                if not internal:
+                    stacklevel -= 1
+
+            code = f.f_code
+            key = code, f.f_lasti
+            call_site = self._call_sites.get(key)
+            if call_site is None:
+                if len(self._call_sites) >= size:
+                    self._call_sites.clear()
+                call_site = self._call_sites[key] = code.co_filename, f.f_lineno, code.co_name, None
+            return call_site
+
+    # the loggers cache their enabled levels since Python 3.7
+    if hasattr(logging.Manager, '_clear_cache'):
+        def isEnabledFor(self, level):
+            """Same as logging.Logger.isEnabledFor, but with `handler_level_filter` on,
+                a level that none of the handlers takes is disabled too. No record is made for it.
+            """
+            if self.disabled:
+                return False
+            try:
+                return self._cache[level]
+            except KeyError:
+                enabled = super().isEnabledFor(level)
+                if enabled and self.config is not None and self.config.handler_level_filter:
+                    enabled = self._cache[level] = level >= self.config.handler_level(self)
+                return enabled
+
     def makeRecord(self, name, level, fn, lno, msg, args, exc_info, func=None, extra=None, sinfo=None):
         record = super().makeRecord(name, level, fn, lno, msg, args, exc_info, func, extra, sinfo)
         record.kwargs = self.msg_kwargs
 
         if name == 'logger_tt':
             # try to get the __name__ of the module that use the default logger: logger_tt
-            pathname = fn.replace('\\', '/')
-            qualified_name = self._logger_names.get(pathname)
-            if not qualified_name:
-                for qualified_name, module in sys.modules.items():
-                    file = getattr(module, '__file__', None)
-                    if file and file.replace('\\', '/') == pathname:
-                        self._logger_names[pathname] = qualified_name
-                        break
+            qualified_name = self._module_index.get(fn.replace('\\', '/'))
 
             if qualified_name == '__main__' and record.processName != 'MainProcess':
                 qualified_name = '__mp_main__'
@@ -74,12 +172,69 @@ class ExceptionLogger(logging.Logger):
             super()._log(level, msg, args, exc_info, extra, stack_info)
 
 
+def _evaluated(value):
+    return value
+
+
+class lazy:
+    """An argument of a log call that is only computed when the message is actually formatted.
+        `logger.debug('state: {state}', state=lazy(dump, big_obj))` doesn't call `dump` if no handler
+        takes the record.
+
+    :param func: the function to call
+    :param args: its positional arguments
+    :param kwargs: its keyword arguments
+    """
+    __slots__ = ('func', 'args', 'kwargs', '_value')
+    _unset = object()
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._value = self._unset
+
+    @property
+    def value(self):
+        """The result of the function, called only once"""
+        if self._value is self._unset:
+            self._value = self.func(*self.args, **self.kwargs)
+        return self._value
+
+    def __reduce__(self):
+        # a record sent to another process carries the value, not the function
+        return _evaluated, (self.value,)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def __format__(self, format_spec):
+        return format(self.value, format_spec)
+
+
 class DefaultLogRecord(logging.LogRecord):
     def __init__(self, name, level, pathname, lineno,
                  msg, args, exc_info, func=None, sinfo=None, **kwargs):
         self.kwargs = kwargs
         super().__init__(name, level, pathname, lineno, msg, args, exc_info, func, sinfo)
 
+    def resolve_lazy(self):
+        """Replace the `lazy` arguments of this record by their values.
+            Called when the message is built, so that the functions run once, only for the formatted records.
+        """
+        args, kwargs = self.args, self.kwargs
+        if isinstance(args, tuple):
+            if any(type(arg) is lazy for arg in args):
+                self.args = tuple([arg.value if type(arg) is lazy else arg for arg in args])
+        elif isinstance(args, Mapping):
+            if any(type(arg) is lazy for arg in args.values()):
+                self.args = {key: arg.value if type(arg) is lazy else arg for key, arg in args.items()}
+        if kwargs and any(type(arg) is lazy for arg in kwargs.values()):
+            self.kwargs = {key: arg.value if type(arg) is lazy else arg for key, arg in kwargs.items()}
+
     def get_message_brace(self):
         """
         Return the message for this LogRecord.
@@ -87,6 +242,7 @@ class DefaultLogRecord(logging.LogRecord):
         Return the message for this LogRecord after merging any user-supplied
         arguments with the message.
         """
+        self.resolve_lazy()
         msg = str(self.msg)
         if self.args and self.kwargs:
             msg = msg.format(*self.args, **self.kwargs)
@@ -103,9 +259,18 @@ class DefaultLogRecord(logging.LogRecord):
         Return the message for this LogRecord after merging any user-supplied
         arguments with the message.
         """
+        self.resolve_lazy()
         msg = str(self.msg)
         if self.kwargs:
-            msg = Template(msg).substitute(self.kwargs)
+            # the parsed templates of the recent messages are cached
+            parsed = parse_template(msg)
+            if parsed is None:
+                # let string.Template raise its error
+                msg = Template(msg).substitute(self.kwargs)
+            else:
+                template, names = parsed
+                kwargs = self.kwargs
+                msg = template % tuple([kwargs[name] for name in names])
 
         return msg
 
@@ -116,6 +281,7 @@ class DefaultLogRecord(logging.LogRecord):
         Return the message for this LogRecord after merging any user-supplied
         arguments with the message.
         """
+        self.resolve_lazy()
         msg = str(self.msg)
         if self.args:
             msg = msg % self.args
@@ -133,7 +299,128 @@ class DefaultLogRecord(logging.LogRecord):
             pass
 
 
-class DefaultFormatter(logging.Formatter):
+@lru_cache(maxsize=4096)
+def parse_template(text: str):
+    """Split a string.Template text into a %-style template and the names of its placeholders.
+        Return None if the text has an invalid placeholder.
+    """
+    if '\0' in text:
+        return None
+
+    names = []
+
+    def field(m):
+        if m.group('escaped') is not None:
+            return '$'
+        if m.group('invalid') is not None:
+            raise ValueError(m.group(0))
+        names.append(m.group('named') or m.group('braced'))
+        return '\0'
+
+    try:
+        parts = Template.pattern.sub(field, text).split('\0')
+    except ValueError:
+        return None
+    return '%s'.join(x.replace('%', '%%') for x in parts), tuple(names)
+
+
+def compile_format(fmt: str, style: str = '%'):
+    """Turn a format string into a function that renders a record with positional formatting.
+        The attributes it needs are read directly instead of looking up the record's __dict__.
+        Return None if the format string uses something this simple compiler doesn't support.
+    """
+    names = []
+    if style == '%':
+        def field(m):
+            if m.group(0) == '%%':
+                return '%%'
+            if not m.group('name'):
+                # positional or incomplete placeholder
+                raise ValueError(m.group(0))
+            names.append(m.group('name'))
+            return '%' + m.group('spec')
+
+        pattern = r'%%|%\((?P<name>\w+)\)(?P<spec>[#0+ -]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa])|%'
+        try:
+            template = re.sub(pattern, field, fmt)
+        except ValueError:
+            return None
+        render = template.__mod__
+
+    elif style == '$':
+        parsed = parse_template(fmt)
+        if parsed is None:
+            return None
+        template, names = parsed[0], list(parsed[1])
+        render = template.__mod__
+
+    elif style == '{':
+        template = ''
+        try:
+            for literal, name, spec, conversion in Formatter().parse(fmt):
+                template += literal.replace('{', '{{').replace('}', '}}')
+                if name is None:
+                    continue
+                if not name.isidentifier() or '{' in spec:
+                    return None
+                template += '{%d%s%s}' % (len(names), f'!{conversion}' if conversion else '', f':{spec}' if spec else '')
+                names.append(name)
+        except ValueError:
+            return None
+
+        def render(values):
+            return template.format(*values)
+
+    else:
+        return None
+
+    if not names:
+        return lambda record: render(())
+
+    get_values = attrgetter(*names)
+    if len(names) == 1:
+        get_value = get_values
+        get_values = lambda record: (get_value(record),)
+
+    def compiled(record):
+        try:
+            return render(get_values(record))
+        except AttributeError as e:
+            raise ValueError('Formatting field not found in record: %s' % e)
+
+    return compiled
+
+
+class CachedTimeFormatter(logging.Formatter):
+    """Format the time of the records only once per second.
+        The text of the current second is shared by all formatters with the same datefmt and converter.
+    """
+    _time_cache = {}    # (datefmt, converter): (second, text)
+    _time_zone = None   # time.tzname when the cache was filled, it is replaced by time.tzset()
+
+    def formatTime(self, record, datefmt=None):
+        cache = CachedTimeFormatter._time_cache
+        if time.tzname is not CachedTimeFormatter._time_zone:
+            # the time zone has changed, the cached texts are wrong
+            cache.clear()
+            CachedTimeFormatter._time_zone = time.tzname
+
+        # every second is converted on its own, so a DST change is applied at the right second
+        key = datefmt or self.default_time_format, self.converter
+        second = int(record.created)
+        cached = cache.get(key)
+        if cached and cached[0] == second:
+            s = cached[1]
+        else:
+            s = time.strftime(key[0], self.converter(second))
+            cache[key] = second, s
+
+        if datefmt or not self.default_msec_format:
+            return s
+        return self.default_msec_format % (s, record.msecs)
+
+
+class DefaultFormatter(CachedTimeFormatter):
     """Based on the format string of any handler in root, we make new formatters for
         the default logger - logger_tt. This is a way to inject information but
         using the same handlers as regular logger.
@@ -142,8 +429,13 @@ class DefaultFormatter(logging.Formatter):
                            thread=["%(message)s", "%(threadName)s %(message)s"],
                            multiprocess=["%(message)s", "%(processName)s %(message)s"],
                            both=["%(message)s", "%(processName)s %(threadName)s %(message)s"])
+    compiled = False    # default of the `compiled` argument, set by `compiled_format` in the logger_tt config
 
-    def __init__(self, fmt: str = '', datefmt: str = '', style: str = '%'):
+    def __init__(self, fmt: str = '', datefmt: str = '', style: str = '%', compiled: bool = None):
+        """
+        :param compiled: bool, compile the format strings into functions that read the record attributes directly.
+            Falls back to the stdlib formatting if a format string can't be compiled.
+        """
         # check the format string and the style
         super(DefaultFormatter, self).__init__(fmt=fmt, datefmt=datefmt, style=style)
 
@@ -158,7 +450,25 @@ class DefaultFormatter(logging.Formatter):
         # now prepare the formatter objects
         self._logger_tt_formatters = {}
         for case, fmt in self._standardize(fmt, style).items():
-            self._logger_tt_formatters[case] = logging.Formatter(fmt=fmt, datefmt=datefmt, style=style)
+            self._logger_tt_formatters[case] = CachedTimeFormatter(fmt=fmt, datefmt=datefmt, style=style)
+
+        # the last formatted record: (weakref of the record, msg, args, text)
+        self._last = (lambda: None), None, None, ''
+
+        # case: (render function, uses time)
+        self._compiled = None
+        if self.compiled if compiled is None else compiled:
+            self._compiled = self._compile(style)
+
+    def _compile(self, style: str):
+        formatters = dict(self._logger_tt_formatters, default=self)
+        compiled = {}
+        for case, formatter in formatters.items():
+            render = compile_format(formatter._fmt, style)
+            if render is None:
+                return None
+            compiled[case] = render, formatter.usesTime()
+        return compiled
 
     @staticmethod
     def get_style_of(fmt: str) -> str:
@@ -228,7 +538,50 @@ class DefaultFormatter(logging.Formatter):
 
         return formatters
 
+    def _format_compiled(self, case: str, record):
+        """Same as logging.Formatter.format, with the compiled format string"""
+        render, uses_time = self._compiled[case]
+        record.message = record.getMessage()
+        if uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+        s = render(record)
+
+        if record.exc_info or record.exc_text or record.stack_info:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                if s[-1:] != "\n":
+                    s = s + "\n"
+                s = s + record.exc_text
+            if record.stack_info:
+                if s[-1:] != "\n":
+                    s = s + "\n"
+                s = s + self.formatStack(record.stack_info)
+        return s
+
     def format(self, record):
+        """A record that is passed to several handlers sharing this formatter is formatted only once.
+            The text is reused only for the same record object with the same msg and args,
+            a copied, pickled or modified record is formatted again.
+        """
+        ref, msg, args, text = self._last
+        if ref() is record and record.msg is msg and record.args is args:
+            return text
+
+        text = self._format(record)
+        self._last = weakref.ref(record), record.msg, record.args, text
+        return text
+
+    def _format(self, record):
+        if self._compiled:
+            if record.name != 'logger_tt':
+                return self._format_compiled('default', record)
+            if record.processName == 'MainProcess':
+                case = 'normal' if record.threadName == 'MainThread' else 'thread'
+            else:
+                case = 'multiprocess' if record.threadName == 'MainThread' else 'both'
+            return self._format_compiled(case, record)
+
         if record.name == 'logger_tt':
             if record.processName == 'MainProcess' and record.threadName == 'MainThread':
                 return self._logger_tt_formatters['normal'].format(record)
@@ -240,3 +593,117 @@ class DefaultFormatter(logging.Formatter):
                 return self._logger_tt_formatters['both'].format(record)
 
         return super(DefaultFormatter, self).format(record)
+
+
+# attributes that every record has, the others are added by context injectors or the `extra` argument
+_record_attributes = frozenset(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) | {
+    'message', 'asctime', 'kwargs', 'exc_analysis', 'taskName'}
+
+
+def get_json_encoder(name: str = None):
+    """Return a function that encodes an object into a JSON text.
+        `name` is 'orjson' or 'json', None for the fastest one that is installed.
+    """
+    if name is None:
+        name = 'json' if orjson is None else 'orjson'
+
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('Required package not found: "orjson"')
+        dumps, option = orjson.dumps, orjson.OPT_NON_STR_KEYS
+        return lambda obj: dumps(obj, default=str, option=option).decode()
+
+    if name == 'json':
+        return json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+
+    raise ValueError(f'Expected "orjson" or "json" encoder, but got: {name}')
+
+
+class JsonFormatter(CachedTimeFormatter):
+    """Format a record into one line of JSON, for the log indexers that read fields instead of text.
+        Besides the record attributes, the layout can use these computed values:
+            message: the message without the analyzed exception
+            asctime: the time formatted by `datefmt`
+            exception: the exception analyzed by logger_tt, else the traceback of `exc_info`
+            stack: the stack info
+            kwargs: the kwargs of the log call
+            extra: the attributes added by the context injectors or the `extra` argument
+        `exception`, `stack`, `kwargs` and `extra` are left out when they are empty.
+    """
+    default_fields = dict(time='asctime', level='levelname', logger='name', message='message',
+                          pathname='pathname', lineno='lineno', function='funcName',
+                          process='processName', thread='threadName',
+                          exception='exception', stack='stack', kwargs='kwargs', extra='extra')
+    optional = ('exception', 'stack', 'kwargs', 'extra')
+
+    def __init__(self, fields: dict = None, datefmt: str = None, encoder: str = None, style: str = None):
+        """
+        :param fields: key in the output: attribute of the record or one of the computed values.
+                       The keys are written in this order.
+        :param datefmt: format of `asctime`, default to the same as logging.Formatter
+        :param encoder: 'orjson' or 'json', None to use orjson if it is installed
+        :param style: style of the log messages, '%', '{' or '$'. None to keep the one of the other formatters
+        """
+        super().__init__(datefmt=datefmt)
+        if style:
+            DefaultLogRecord.set_style(style)
+        self.fields = dict(fields or self.default_fields)
+        self.encode = get_json_encoder(encoder)
+
+        # the layout is turned once into one attrgetter, `message` and `asctime` are set on the record first.
+        # The other computed values are filled in by their position
+        computers = dict(exception=self._exception, stack=self._stack, kwargs=self._kwargs, extra=self._extra)
+        self._keys = tuple(self.fields)
+        self._computed = [(i, computers[attr]) for i, attr in enumerate(self.fields.values()) if attr in computers]
+        self._optional_keys = [key for key, attr in self.fields.items() if attr in computers]
+        self._uses_time = 'asctime' in self.fields.values()
+
+        get_values = attrgetter(*[('name' if attr in computers else attr) for attr in self.fields.values()])
+        self._get_values = get_values if len(self.fields) > 1 else lambda record: (get_values(record),)
+
+    def usesTime(self):
+        return self._uses_time
+
+    def format(self, record):
+        fields = record.__dict__
+        message = record.message = record.getMessage()
+        analysis = fields.get('exc_analysis')
+        if analysis:
+            # the analyzed exception goes in its own field, with the traceback that the queue may have added after it
+            end = message.find('\n' + analysis)
+            if end >= 0:
+                record.message = message[:end]
+        if self._uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+
+        values = self._get_values(record)
+        if self._computed:
+            values = list(values)
+            for i, compute in self._computed:
+                values[i] = compute(record, fields)
+
+        obj = dict(zip(self._keys, values))
+        for key in self._optional_keys:
+            if not obj[key]:
+                del obj[key]
+        return self.encode(obj)
+
+    def _exception(self, record, fields: dict):
+        analysis = fields.get('exc_analysis')
+        if analysis:
+            # it already tells everything of the traceback of exc_info
+            return analysis
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        return record.exc_text
+
+    def _stack(self, record, fields: dict):
+        return record.stack_info and self.formatStack(record.stack_info)
+
+    @staticmethod
+    def _kwargs(record, fields: dict):
+        return fields.get('kwargs')
+
+    @staticmethod
+    def _extra(record, fields: dict):
+        return {key: val for key, val in fields.items() if key not in _record_attributes and not key.startswith('_')}
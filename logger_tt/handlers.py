@@ -1,47 +1,193 @@
+import copy
 import logging
 import time
 import os
 import json
-from urllib import request, parse, error
-from collections import deque, defaultdict
-from threading import Thread, Event
-from datetime import datetime
+import mmap
+import gzip
+import shutil
+import threading
+import socket
+from http import client
+from urllib import parse
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone, time as dt_time
+from logging import handlers
+from typing import Optional
+
+from .scheduler import get_scheduler, get_background_worker
+
+try:
+    import bz2
+    import lzma
+except ImportError:
+    # python is built without these libraries
+    bz2 = lzma = None
 
 
 root_logger = logging.getLogger('logger_tt')
 
 
-class StreamHandlerWithBuffer(logging.StreamHandler):
-    def __init__(self, stream=None, buffer_time: float = 0.2, buffer_lines: int = 50, debug=False):
-        super().__init__(stream)
+class BufferMixing:
+    """Cache the formatted log lines and write them out at once.
+        The cache is flushed after `buffer_time` seconds, or when it has `buffer_lines` lines,
+        or `buffer_bytes` bytes, or a record at or above `flush_level` arrives.
+        Must be put before the logging.StreamHandler based class in the bases list.
+    """
+    DEFAULT_BINARY_SIZE = 64 * 1024     # size of the encode buffer if binary is used without buffer_bytes
+
+    stream: object
+    terminator: str
+
+    def _init_buffer(self, buffer_time: float, buffer_lines: int, buffer_bytes: int,
+                     binary: bool, flush_level, debug: bool):
         assert buffer_time >= 0 or buffer_lines >= 0, "At least one kind of buffer must be set"
 
         self.buffer_time = buffer_time
         self.buffer_lines = buffer_lines
+        self.buffer_bytes = max(0, int(buffer_bytes))
         self.buffer = []
         self.debug = debug
+        self.flush_level = logging._checkLevel(flush_level or 0)
+
+        # binary mode: a fixed size bytearray that is reused after every flush
+        self.binary = binary
+        self._bytes = bytearray(self.buffer_bytes or self.DEFAULT_BINARY_SIZE) if binary else None
+        self._lines = 0
+        self._size = 0
 
-        self._stop_event = Event()
+        self._flush_task = None
         if self.buffer_time:
-            watcher = Thread(target=self.watcher, daemon=True)
-            watcher.start()
+            if self.debug:
+                self._append(f'{type(self).__name__} watcher starts: {datetime.now()}')
+            self._flush_task = get_scheduler().every(self.buffer_time, self.watcher,
+                                                     name=f'{type(self).__name__} flush {id(self)}')
 
     def close(self) -> None:
-        self._stop_event.set()
+        if self._flush_task:
+            self._flush_task.cancel()
+
+        # don't lose what is left in the buffer
+        try:
+            self.flush()
+        except (OSError, ValueError):
+            # the stream was already closed
+            pass
+        super().close()
+
+    def flush(self):
+        """Write out all the cached lines, then flush the stream"""
+        with self.lock:
+            if self._lines:
+                self.export()
+            else:
+                super().flush()
+
+    def _encode(self, msg: str) -> bytes:
+        stream = self.stream
+        encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        errors = getattr(stream, 'errors', None) or 'strict'
+        return (msg + self.terminator).encode(encoding, errors)
+
+    def _append(self, msg: str):
+        """Put one log line into the buffer"""
+        if self._bytes is None:
+            self._lines += 1
+            self.buffer.append(msg)
+            self._size += len(msg) + len(self.terminator)
+        else:
+            self._append_bytes(self._encode(msg))
+
+    def _append_bytes(self, data: bytes):
+        size = len(data)
+        capacity = len(self._bytes)
+        if self._size + size > capacity:
+            # not enough room left, write out what we have first
+            self._write_buffer()
+
+        if size > capacity:
+            # a line that is longer than the whole buffer goes out alone
+            self._write_bytes(data)
+        else:
+            # counted after the buffer was written out, which resets the count
+            self._lines += 1
+            self._bytes[self._size:self._size + size] = data
+            self._size += size
+
+    def _write_bytes(self, data):
+        stream = self.stream
+        raw = getattr(stream, 'buffer', None)
+        if raw is None:
+            # text only stream such as StringIO or a GUI widget
+            encoding = getattr(stream, 'encoding', None) or 'utf-8'
+            stream.write(bytes(data).decode(encoding))
+        else:
+            # keep the order with anything written to the text layer before
+            stream.flush()
+            raw.write(data)
+
+    def _write_buffer(self):
+        """Write the buffer out to the stream as one piece, then empty it"""
+        if self._bytes is None:
+            msg = self.terminator.join(self.buffer)
+            # issue 35046: merged two stream.writes into one.
+            self.stream.write(msg + self.terminator)
+            self.buffer.clear()
+        elif self._size:
+            with memoryview(self._bytes) as view:
+                self._write_bytes(view[:self._size])
+
+        self._lines = 0
+        self._size = 0
 
     def export(self):
         """Actual writing data out to the stream"""
 
         if self.debug:
-            self.buffer.append(f'StreamHandlerWithBuffer flush: {datetime.now()}')
+            self._append(f'{type(self).__name__} flush: {datetime.now()}')
 
-        msg = self.terminator.join(self.buffer)
-        stream = self.stream
-        # issue 35046: merged two stream.writes into one.
-        stream.write(msg + self.terminator)
-        self.flush()
+        self._write_buffer()
+        super().flush()
+
+    def _should_export(self, record) -> bool:
+        if self.flush_level and record.levelno >= self.flush_level:
+            # keep the evidence in case the process is going to crash
+            return True
+        if self.buffer_lines and self._lines >= self.buffer_lines:
+            return True
+        if self.buffer_bytes and self._size >= self.buffer_bytes:
+            return True
+        return False
+
+    def watcher(self):
+        """
+        If buffer_time is used, the shared scheduler calls this method
+        to flush the buffer after every buffer_time seconds has passed.
+        """
+        if self._lines:
+            with self.lock:
+                self.export()
 
-        self.buffer.clear()
+
+class StreamHandlerWithBuffer(BufferMixing, logging.StreamHandler):
+    def __init__(self, stream=None, buffer_time: float = 0.2, buffer_lines: int = 50, debug=False,
+                 buffer_bytes: int = 0, binary: bool = False, flush_level=logging.ERROR):
+        """ Init stream handler with buffer
+
+        :param stream: the stream to write the log to, default to sys.stderr
+        :param buffer_time: flush the buffer every this seconds
+        :param buffer_lines: flush the buffer when this number of lines is cached
+        :param debug: bool, log the time the buffer is flushed
+        :param buffer_bytes: flush the buffer when its size reaches this number of bytes.
+            In text mode, the size is counted in characters.
+        :param binary: encode the log lines straight into a preallocated bytearray
+            and write it to the binary buffer of the stream
+        :param flush_level: a record at or above this level flushes the buffer immediately.
+            Set to 0 or None to treat every record the same.
+        """
+        super().__init__(stream)
+        self._init_buffer(buffer_time, buffer_lines, buffer_bytes, binary, flush_level, debug)
 
     def emit(self, record):
         """
@@ -56,8 +202,8 @@ class StreamHandlerWithBuffer(logging.StreamHandler):
         """
         try:
             msg = self.format(record)
-            self.buffer.append(msg)
-            if self.buffer_lines and len(self.buffer) >= self.buffer_lines:
+            self._append(msg)
+            if self._should_export(record):
                 self.export()
 
         except RecursionError:  # See issue 36272
@@ -65,28 +211,776 @@ class StreamHandlerWithBuffer(logging.StreamHandler):
         except Exception:
             self.handleError(record)
 
-    def watcher(self):
+
+def _unused_rotation_name(handler: handlers.BaseRotatingHandler, suffix: str) -> str:
+    """Return `baseFilename.suffix`, or `baseFilename.suffix.N` if the file is rotated several times
+        within the same suffix, that is not used by any rotated file yet
+    """
+    archiver = getattr(handler, 'archiver', None)
+    extension = archiver.extension if archiver else ''
+
+    name, count = handler.rotation_filename(f'{handler.baseFilename}.{suffix}'), 0
+    while os.path.exists(name) or extension and os.path.exists(name + extension):
+        count += 1
+        name = handler.rotation_filename(f'{handler.baseFilename}.{suffix}.{count}')
+    return name
+
+
+class LogArchiver:
+    """A `rotator` that hands the rotated log files to the background worker.
+
+        The logging thread only renames the finished file. The worker then compresses it
+        and deletes old rotated files that exceed the retention limits.
+        It works with the handlers that give each rotated file a name of its own, `BufferedRotatingFileHandler`
+        and the stdlib `TimedRotatingFileHandler`: `handler.rotator = LogArchiver('gzip', backup_count=15)`.
+        Not with the stdlib `RotatingFileHandler`, which renames its numbered backups at every rotation,
+        maybe while the worker is still compressing one of them.
+    """
+    COMPRESSORS = {'': (None, ''), 'gzip': (gzip.open, '.gz')}
+    if bz2 and lzma:
+        COMPRESSORS.update({'bz2': (bz2.open, '.bz2'), 'lzma': (lzma.open, '.xz')})
+
+    def __init__(self, compress: str = 'gzip', backup_count: int = 0, max_total_size: int = 0,
+                 max_age_days: float = 0):
         """
-        If buffer_time is used, this method will flush the buffer
-        after every buffer_time seconds has passed.
+        :param compress: '', 'gzip', 'bz2' or 'lzma'
+        :param backup_count: number of rotated files to keep, 0: no limit
+        :param max_total_size: delete the oldest rotated files until their total size is below this, 0: no limit
+        :param max_age_days: delete rotated files older than this, 0: no limit
         """
-        if self.debug:
-            self.buffer.append(f'StreamHandlerWithBuffer watcher starts: {datetime.now()}')
-        while not self._stop_event.is_set():
-            time.sleep(self.buffer_time)
-            if self.buffer:
-                with self.lock:
-                    self.export()
+        compress = (compress or '').lower()
+        if compress not in self.COMPRESSORS:
+            raise ValueError(f'"compress" must be one of {list(self.COMPRESSORS)}, but got: {compress}')
+
+        self.compress = compress
+        self.opener, self.extension = self.COMPRESSORS[compress]
+        self.backup_count = max(0, int(backup_count))
+        self.max_total_size = max(0, int(max_total_size))
+        self.max_age_days = max(0, max_age_days)
+        self.worker = get_background_worker()
+
+    def __call__(self, source: str, dest: str):
+        if not os.path.exists(source):
+            return
+
+        # renaming is cheap, everything else is done in the background
+        os.replace(source, dest)
+        self.worker.submit(self.archive, source, dest)
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait for the background work to finish"""
+        return self.worker.join(timeout)
+
+    def archive(self, source: str, dest: str):
+        # the file may be gone already, removed by the retention of a rotation that came after it
+        if self.opener and os.path.exists(dest):
+            self.compress_file(dest)
+        self.apply_retention(source)
+
+    def compress_file(self, path: str) -> str:
+        target = path + self.extension
+        temp = target + '.tmp'
+        stat = os.stat(path)
+        with open(path, 'rb') as fi, self.opener(temp, 'wb') as fo:
+            shutil.copyfileobj(fi, fo, 1024 * 1024)
+
+        # the retention orders the files by their time, the compressed file keeps the one of the log
+        os.utime(temp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        # the original is removed only after the compressed file is completed
+        os.replace(temp, target)
+        os.remove(path)
+        return target
+
+    def rotated_files(self, source: str) -> list:
+        """Rotated files of the log file `source`, oldest first"""
+        folder, base_name = os.path.split(source)
+        prefix = base_name + '.'
+        files = []
+        for name in os.listdir(folder or '.'):
+            if name.startswith(prefix) and not name.endswith('.tmp'):
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+
+        files.sort()
+        return files
+
+    def apply_retention(self, source: str):
+        files = self.rotated_files(source)
+
+        to_delete = set()
+        if self.backup_count and len(files) > self.backup_count:
+            to_delete.update(path for _, path, _ in files[:-self.backup_count])
+
+        if self.max_age_days:
+            oldest = time.time() - self.max_age_days * 24 * 60 * 60
+            to_delete.update(path for mtime, path, _ in files if mtime < oldest)
+
+        if self.max_total_size:
+            total = sum(size for _, path, size in files if path not in to_delete)
+            for _, path, size in files:
+                if total <= self.max_total_size:
+                    break
+                if path not in to_delete:
+                    to_delete.add(path)
+                    total -= size
+
+        for path in to_delete:
+            os.remove(path)
+
+
+class BufferedRotatingFileHandler(BufferMixing, handlers.BaseRotatingHandler):
+    """A file handler that caches the log lines like `StreamHandlerWithBuffer`
+        and rotates the log file by size, by time or both.
+
+        The next rollover time is computed once per rollover and compared against `record.created`,
+        the file size is tracked in memory. So there is no `stat` nor `time` call per record.
+    """
+    WHEN = {'S': (1, '%Y-%m-%d_%H-%M-%S'),
+            'M': (60, '%Y-%m-%d_%H-%M'),
+            'H': (60 * 60, '%Y-%m-%d_%H'),
+            'D': (60 * 60 * 24, '%Y-%m-%d'),
+            'MIDNIGHT': (60 * 60 * 24, '%Y-%m-%d')}
+
+    def __init__(self, filename, mode='a', maxBytes: int = 0, when: str = '', interval: int = 1,
+                 backupCount: int = 0, encoding=None, delay=False, utc=False,
+                 buffer_time: float = 0.5, buffer_lines: int = 0, buffer_bytes: int = 64 * 1024,
+                 flush_level=logging.ERROR, debug=False,
+                 compress: str = '', max_total_size: int = 0, max_age_days: float = 0):
+        """ Init buffered rotating file handler
+
+        :param filename: path of the log file
+        :param mode: file open mode
+        :param maxBytes: rotate the file before it grows over this size, 0: no size limit
+        :param when: rotate the file by time. Same values as the TimedRotatingFileHandler:
+            'S', 'M', 'H', 'D', 'MIDNIGHT' or 'W0'-'W6'. Empty string: no time rotation.
+        :param interval: rotate every this number of `when`. Not used for 'MIDNIGHT' and 'W0'-'W6'
+        :param backupCount: number of rotated files to keep, 0: keep all of them
+        :param encoding: file encoding
+        :param delay: not to open the file until the first record is emitted
+        :param utc: use UTC time instead of local time for rotating and naming the files
+
+        For buffering, see StreamHandlerWithBuffer:
+        :param buffer_time: flush the buffer every this seconds
+        :param buffer_lines: flush the buffer when this number of lines is cached
+        :param buffer_bytes: flush the buffer when its size reaches this number of bytes
+        :param flush_level: a record at or above this level flushes the buffer immediately
+        :param debug: bool, log the time the buffer is flushed
+
+        Rotated files are compressed and cleaned up in the background if one of these is set, see LogArchiver:
+        :param compress: '', 'gzip', 'bz2' or 'lzma'
+        :param max_total_size: delete the oldest rotated files until their total size is below this
+        :param max_age_days: delete rotated files older than this number of days
+        """
+        if maxBytes > 0:
+            mode = 'a'
+        super().__init__(filename, mode, encoding, delay)
+
+        self.maxBytes = max(0, int(maxBytes))
+        self.backupCount = max(0, int(backupCount))
+        self.utc = utc
+        self.when = when.upper() if when else ''
+        if self.when.startswith('W'):
+            if len(self.when) != 2 or self.when[1] not in '0123456':
+                raise ValueError(f'Invalid day specified for weekly rollover: {when}')
+            self.dayOfWeek = int(self.when[1])
+            self.interval, self.suffix = self.WHEN['D']
+        elif self.when:
+            if self.when not in self.WHEN:
+                raise ValueError(f'Invalid rollover interval specified: {when}')
+            self.interval, self.suffix = self.WHEN[self.when]
+            if self.when != 'MIDNIGHT':
+                self.interval *= max(1, int(interval))
+        else:
+            self.interval, self.suffix = 0, self.WHEN['S'][1]
+
+        # the time this file was started and the time it must be rotated
+        filename = self.baseFilename
+        start = os.stat(filename).st_mtime if os.path.exists(filename) else time.time()
+        self.periodStart = start
+        self.rolloverAt = self.computeRollover(start)
+        self._file_size = os.path.getsize(filename) if os.path.exists(filename) and 'a' in mode else 0
+
+        self.archiver = None
+        if compress or max_total_size or max_age_days or self.backupCount:
+            self.archiver = LogArchiver(compress, self.backupCount, max_total_size, max_age_days)
+            self.rotator = self.archiver
+
+        self._init_buffer(buffer_time, buffer_lines, buffer_bytes, True, flush_level, debug)
+
+    def computeRollover(self, current_time: float) -> float:
+        """Return the timestamp that the file opened at `current_time` should be rotated"""
+        if not self.when:
+            return float('inf')
+
+        if self.when in ('S', 'M', 'H', 'D'):
+            return current_time + self.interval
+
+        # midnight or weekly, calculated on the calendar to be correct over DST changes
+        tz = timezone.utc if self.utc else None
+        current = datetime.fromtimestamp(current_time, tz)
+        days = 1
+        if self.when.startswith('W'):
+            days = (self.dayOfWeek - current.weekday()) % 7 or 7
+        midnight = datetime.combine(current.date() + timedelta(days=days), dt_time(0, tzinfo=tz))
+        return midnight.timestamp()
+
+    def _should_rollover(self, record, size: int) -> bool:
+        if record.created >= self.rolloverAt:
+            return True
+
+        if self.maxBytes:
+            pending = self._file_size + self._size
+            return pending and pending + size > self.maxBytes
+
+        return False
+
+    def _rotated_filename(self) -> str:
+        t = self.periodStart
+        time_tuple = time.gmtime(t) if self.utc else time.localtime(t)
+        return _unused_rotation_name(self, time.strftime(self.suffix, time_tuple))
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        if os.path.exists(self.baseFilename):
+            # retention of the rotated files is done by the archiver
+            self.rotate(self.baseFilename, self._rotated_filename())
+
+        now = time.time()
+        self.periodStart = now
+        self.rolloverAt = self.computeRollover(now)
+        self._file_size = 0
+        if not self.delay:
+            self.stream = self._open()
+
+    def _write_bytes(self, data):
+        super()._write_bytes(data)
+        self._file_size += len(data)
+
+    def close(self) -> None:
+        super().close()
+        if self.archiver:
+            # give the last rotated file a chance to be compressed
+            self.archiver.join(timeout=5)
+
+    def _open(self):
+        stream = super()._open()
+        # looked up once per file instead of once per record
+        self._encoding = stream.encoding
+        self._errors = stream.errors or 'strict'
+        return stream
+
+    def emit(self, record):
+        # this is the hot path, the buffer methods are inlined on purpose
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+
+            data = (self.format(record) + self.terminator).encode(self._encoding, self._errors)
+            size = len(data)
+            if self._should_rollover(record, size):
+                self._write_buffer()
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+
+            end = self._size + size
+            if end <= len(self._bytes):
+                self._bytes[self._size:end] = data
+                self._size = end
+                self._lines += 1
+            else:
+                self._append_bytes(data)
+
+            if self.flush_level and record.levelno >= self.flush_level:
+                self.export()
+            elif self.buffer_lines and self._lines >= self.buffer_lines:
+                self.export()
+            elif self.buffer_bytes and self._size >= self.buffer_bytes:
+                self.export()
+
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class MMapFileHandler(handlers.BaseRotatingHandler):
+    """Write the log into a preallocated file through a memory map.
+
+        The file is preallocated in segments of `segment_size` bytes filled with NUL bytes.
+        Records are encoded and copied straight into the mapping, there is no system call per record.
+        When a segment is full, the file is truncated to its real length and rotated,
+        then a new segment is started.
+
+        If the process crashes, the written records are still in the file:
+        valid data ends at the first NUL byte. The next run continues from there.
+        Only one process should write to the file.
+    """
+
+    def __init__(self, filename, segment_size: int = 16 * 1024 * 1024, backupCount: int = 0,
+                 encoding='utf-8', delay=False, compress: str = '', max_total_size: int = 0,
+                 max_age_days: float = 0):
+        """ Init memory-mapped file handler
+
+        :param filename: path of the log file
+        :param segment_size: size of the preallocated file. The file is rotated when it is full.
+        :param backupCount: number of rotated files to keep, 0: keep all of them
+        :param encoding: file encoding
+        :param delay: not to open the file until the first record is emitted
+        :param compress: '', 'gzip', 'bz2' or 'lzma', compress the rotated files. See LogArchiver
+        :param max_total_size: delete the oldest rotated files until their total size is below this
+        :param max_age_days: delete rotated files older than this number of days
+        """
+        # the FileHandler's stream is never used, the file is opened with mmap below
+        super().__init__(filename, 'ab', None, True)
+
+        self.segment_size = max(mmap.ALLOCATIONGRANULARITY, int(segment_size))
+        self.backupCount = max(0, int(backupCount))
+        self.encoding = encoding or 'utf-8'
+        self.delay = delay
+        self.archiver = None
+        if compress or max_total_size or max_age_days or self.backupCount:
+            self.archiver = LogArchiver(compress, self.backupCount, max_total_size, max_age_days)
+            self.rotator = self.archiver
+
+        self._fd = None
+        self._map = None
+        self._pos = 0
+        if not delay:
+            self._open_segment()
+
+    def _open_segment(self, min_size: int = 0):
+        fd = os.open(self.baseFilename, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        size = os.fstat(fd).st_size
+
+        # continue after the valid data of the previous run
+        end = 0
+        if size:
+            with mmap.mmap(fd, size) as old:
+                end = old.find(b'\0')
+            end = size if end == -1 else end
+
+        segment_size = max(self.segment_size, min_size)
+        if end and end + min_size > segment_size:
+            # no room left for the next record
+            os.ftruncate(fd, end)
+            os.close(fd)
+            self._rotate_file()
+            fd = os.open(self.baseFilename, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            end = 0
+
+        os.ftruncate(fd, segment_size)
+        self._fd = fd
+        self._map = mmap.mmap(fd, segment_size)
+        self._pos = end
+
+    def _close_segment(self):
+        """Unmap the file and cut off the unused part"""
+        if self._map is None:
+            return
+
+        self._map.close()
+        os.ftruncate(self._fd, self._pos)
+        os.close(self._fd)
+        self._map = self._fd = None
+        self._pos = 0
+
+    def _rotate_file(self):
+        suffix = time.strftime('%Y-%m-%d_%H-%M-%S')
+        self.rotate(self.baseFilename, _unused_rotation_name(self, suffix))
+
+    def doRollover(self, min_size: int = 0):
+        self._close_segment()
+        self._rotate_file()
+        self._open_segment(min_size)
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode(self.encoding, 'backslashreplace')
+            if b'\0' in data:
+                # NUL marks the end of valid data
+                data = data.replace(b'\0', b'\\x00')
+
+            if self._map is None:
+                self._open_segment(len(data))
+
+            end = self._pos + len(data)
+            if end > len(self._map):
+                self.doRollover(len(data))
+                end = len(data)
+
+            self._map[self._pos:end] = data
+            self._pos = end
+
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Ask the OS to write the mapped pages to disk"""
+        with self.lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self.lock:
+            self._close_segment()
+            super().close()
+        if self.archiver:
+            self.archiver.join(timeout=5)
+
+
+class AppendFileHandler(BufferMixing, logging.FileHandler):
+    """A file handler that many processes can write to at the same time.
+
+        The file is opened with O_APPEND and each record, or each batch of records up to `atomic_size`,
+        is written with a single `write` call. On a local file system, O_APPEND moves to the end
+        and writes in one step, so lines from different processes never interleave.
+        A write that the system only partly accepts (a full disk, a signal) is completed by another call,
+        the rest of that batch may then come after the line of another process.
+        With multiprocessing, every process writes to this handler directly instead of
+        sending its records to the log server.
+    """
+    multiprocess_safe = True
+    ATOMIC_SIZE = 4096
+
+    def __init__(self, filename, encoding=None, delay=False, buffer_time: float = 0, buffer_lines: int = 1,
+                 atomic_size: int = ATOMIC_SIZE, flush_level=logging.ERROR, debug=False):
+        """ Init append file handler
+
+        :param filename: path of the log file
+        :param encoding: file encoding
+        :param delay: not to open the file until the first record is emitted
+        :param buffer_time: write the cached records out every this seconds. 0: no time buffer
+        :param buffer_lines: write the cached records out when this number of lines is cached.
+            1: write every record immediately
+        :param atomic_size: max size of a batch in one write. A record that is longer than this is written alone.
+        :param flush_level: a record at or above this level is written out immediately
+        :param debug: bool, log the time the buffer is flushed
+        """
+        super().__init__(filename, 'ab', None, delay)
+        self.encoding = encoding or 'utf-8'
+        self._init_buffer(buffer_time, buffer_lines, atomic_size, True, flush_level, debug)
+
+    def _open(self):
+        # unbuffered: one write() is one system call
+        return open(self.baseFilename, 'ab', buffering=0)
+
+    def _encode(self, msg: str) -> bytes:
+        return (msg + self.terminator).encode(self.encoding, 'backslashreplace')
+
+    def _write_bytes(self, data):
+        # write() may take fewer bytes than given, continue with the rest
+        view = memoryview(data)
+        while view:
+            written = self.stream.write(view)
+            if not written:
+                raise OSError(f'Could not write to {self.baseFilename}')
+            view = view[written:]
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+
+            self._append_bytes(self._encode(self.format(record)))
+            if self._should_export(record):
+                self.export()
+
+        except RecursionError:  # See issue 36272
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class TokenBucket:
+    """Allow `rate` requests per second on average and bursts of up to `capacity` requests.
+        `pause` blocks the bucket for a while, such as the `retry_after` seconds told by the server.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Seconds to wait until a token is available. 0: one is available now"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class DeliveryStats:
+    """Delivery latency of one destination: the round trip time of its HTTP requests, in seconds"""
+    __slots__ = ('sent', 'failed', 'total', 'max', 'last')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, latency: float, ok: bool):
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self.total += latency
+        self.last = latency
+        self.max = max(self.max, latency)
+
+    @property
+    def avg(self) -> float:
+        count = self.sent + self.failed
+        return self.total / count if count else 0.0
+
+    def __repr__(self):
+        return (f'<DeliveryStats sent={self.sent} failed={self.failed} '
+                f'avg={self.avg * 1000:.1f}ms max={self.max * 1000:.1f}ms last={self.last * 1000:.1f}ms>')
+
+
+class HttpDeliveryMixing:
+    """Deliver the log over HTTP without holding up the logging thread.
+
+        The handler queues the records in `emit`. A delivery thread of the handler, started on the first record,
+        calls `send()`, which the handler implements. Each destination has its own keep-alive connection,
+        delivery stats and an optional token bucket, up to `max_workers` destinations are sent to at the same time.
+    """
+    TIMEOUT = 10            # seconds of one HTTP request
+    FLUSH_TIMEOUT = 5       # max seconds flush() waits for the delivery thread
+    _url: parse.SplitResult
+    _connections: dict
+    delivery_stats: dict
+    _global_bucket: Optional[TokenBucket] = None
+    _buckets: dict = {}
+
+    def _init_delivery(self, destinations: list, max_workers: int = 1):
+        self.delivery_stats = {x: DeliveryStats() for x in destinations}
+        self._send_lock = threading.Lock()
+        self._bucket_lock = threading.Lock()
+        self._delivery = threading.Condition()
+        self._delivery_thread = None    # type: Optional[threading.Thread]
+        self._delivery_pid = None
+        self._pending = False
+        self._sending = False
+        self._closed = False
+        self._retry_task = None
+        self.max_workers = max_workers
+        self._executor = None           # type: Optional[ThreadPoolExecutor]
+        self._executor_pid = None
+
+    def send(self):
+        raise NotImplementedError
+
+    def set_base_url(self, base_url: str):
+        url = parse.urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f'"base_url" must be an http or https url, but got: {base_url}')
 
+        self._url = url
+        if hasattr(self, '_connections'):
+            self._close_connection()
+        self._connections = {}
 
-class TelegramMixing:
-    _base_url: str
+    def set_buckets(self, rate_limit: float, destination_rates: dict):
+        """A global bucket of `rate_limit` requests per second and one bucket for each destination.
+            0: no limit
+        """
+        self._global_bucket = TokenBucket(rate_limit, rate_limit) if rate_limit else None
+        self._buckets = {x: TokenBucket(rate) if rate else None for x, rate in destination_rates.items()}
+
+    def _sleep(self, seconds: float) -> bool:
+        """Return False if the waiting was interrupted by closing the handler"""
+        with self._delivery:
+            return not self._delivery.wait_for(lambda: self._closed, seconds)
+
+    def _acquire(self, _id_):
+        """Wait until both the global bucket and the bucket of this destination allow one more request"""
+        buckets = [b for b in (self._global_bucket, self._buckets.get(_id_)) if b]
+        while buckets:
+            # the global bucket is shared by the threads of all destinations
+            with self._bucket_lock:
+                delay = max(b.delay() for b in buckets)
+                if delay <= 0:
+                    for bucket in buckets:
+                        bucket.take()
+                    return
+            if not self._sleep(delay):
+                return
+
+    def _pause(self, _id_, seconds: float):
+        """The server asked to wait. Block the destination and the global bucket for that long,
+            then wake the delivery thread to resend what failed meanwhile
+        """
+        with self._bucket_lock:
+            for bucket in (self._global_bucket, self._buckets.get(_id_)):
+                if bucket:
+                    bucket.pause(seconds)
+
+            # one retry for the longest wait asked, not one per failed request
+            task = self._retry_task
+            if task is None or task.cancelled or task.deadline < time.monotonic() + seconds:
+                if task is not None:
+                    task.cancel()
+                self._retry_task = get_scheduler().after(seconds, self._wake_delivery,
+                                                         name=f'{type(self).__name__} retry {id(self)}')
+
+    def _get_connection(self, _id_) -> client.HTTPConnection:
+        connection = self._connections.get(_id_)
+        if connection is None:
+            klass = client.HTTPSConnection if self._url.scheme == 'https' else client.HTTPConnection
+            connection = self._connections[_id_] = klass(self._url.hostname, self._url.port, timeout=self.TIMEOUT)
+        return connection
+
+    def _close_connection(self, _id_=None):
+        """Close the connection of this destination, or all of them"""
+        for x in [_id_] if _id_ is not None else list(self._connections):
+            connection = self._connections.pop(x, None)
+            if connection is not None:
+                connection.close()
+
+    def _post(self, _id_, path: str, body: bytes, headers: dict):
+        """Send the body through the kept-alive connection of this destination,
+            reconnect once if the server has closed it. Return the response and its data.
+        """
+        t0 = time.perf_counter()
+        for retry in (True, False):
+            reused = _id_ in self._connections
+            connection = self._get_connection(_id_)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._close_connection(_id_)
+                if not (retry and reused):
+                    raise
+            except Exception:
+                self._close_connection(_id_)
+                raise
+
+        self.delivery_stats[_id_].add(time.perf_counter() - t0, 200 <= response.status < 300)
+        return response, data
+
+    def _fan_out(self, func, destinations: list):
+        """Call func(destination) for all destinations at the same time, return when all are done"""
+        if len(destinations) < 2 or self.max_workers < 2:
+            for _id_ in destinations:
+                func(_id_)
+            return
+
+        # threads don't survive a fork, the child has to start its own pool
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor_pid = os.getpid()
+            self._executor = ThreadPoolExecutor(min(self.max_workers, len(destinations)),
+                                                thread_name_prefix=f'{type(self).__name__} fan-out {id(self)}')
+
+        futures = [self._executor.submit(func, _id_) for _id_ in destinations]
+        for future in futures:
+            future.result()
+
+    def flush(self):
+        """Wait until the delivery thread has nothing left to send, at most FLUSH_TIMEOUT seconds"""
+        with self._delivery:
+            self._delivery.wait_for(lambda: not self._pending and not self._sending, self.FLUSH_TIMEOUT)
+
+    def _stop_delivery(self):
+        """Let the delivery thread finish its current sending then stop"""
+        if self._retry_task is not None:
+            self._retry_task.cancel()
+        with self._delivery:
+            self._closed = True
+            self._delivery.notify_all()
+
+    def _delivery_stopped(self):
+        """Called in the delivery thread when it stops, release the resources here"""
+        self._close_connection()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def _wake_delivery(self):
+        """Ask the delivery thread to send the queue. It costs no network I/O to the caller"""
+        with self._delivery:
+            if self._closed:
+                return
+
+            # threads don't survive a fork, the child has to start its own one
+            thread = self._delivery_thread
+            if not (thread and thread.is_alive() and self._delivery_pid == os.getpid()):
+                self._delivery_pid = os.getpid()
+                self._delivery_thread = threading.Thread(target=self._deliver, daemon=True,
+                                                         name=f'{type(self).__name__} delivery {id(self)}')
+                self._delivery_thread.start()
+
+            self._pending = True
+            self._delivery.notify_all()
+
+    def _deliver(self):
+        while True:
+            with self._delivery:
+                self._delivery.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    self._delivery_stopped()
+                    return
+                self._pending = False
+                self._sending = True
+
+            try:
+                with self._send_lock:
+                    self.send()
+            except Exception:
+                root_logger.exception(f'{type(self).__name__} delivery failed')
+            finally:
+                with self._delivery:
+                    self._sending = False
+                    self._delivery.notify_all()
+
+
+class TelegramMixing(HttpDeliveryMixing):
+    """Telegram Bot API client.
+        The requests are spread by a global token bucket and one bucket for each chat.
+    """
+    _send_path: str
     feedback: dict
 
-    def set_bot_token(self, token):
-        self._base_url = f"https://api.telegram.org/bot{token}/sendMessage"
-    
-    def _build_message_url(self, unique_id: str, text: str):
+    def set_rate_limits(self, rate_limit: float, chat_rate_limit: float, group_rate_limit: float):
+        """Max messages per second of the bot, of each user chat and of each group chat (negative chat_id).
+            0: no limit
+        """
+        rates = {}
+        for unique_id in self._unique_ids:
+            chat_id = unique_id.split(':')[-1].split('@')[0]
+            rates[unique_id] = group_rate_limit if chat_id.startswith('-') else chat_rate_limit
+        self.set_buckets(rate_limit, rates)
+
+    def set_bot_token(self, token, base_url='https://api.telegram.org'):
+        self.set_base_url(base_url)
+        self._send_path = f"{self._url.path.rstrip('/')}/bot{token}/sendMessage"
+
+    def _build_message_body(self, unique_id: str, text: str) -> bytes:
         # remove name/label if presence
         unique_id = unique_id.split(':')[-1]
 
@@ -101,60 +995,252 @@ class TelegramMixing:
         if '@' in unique_id:
             params['message_thread_id'] = unique_id.split('@')[1]
 
-        # generate a full url
-        url = f"{self._base_url}?{parse.urlencode(params)}"
-        return url
+        return parse.urlencode(params).encode()
 
-    @staticmethod
-    def __request_handle_http_errors(exception, url: str):
-        root_logger.error(exception)
-        if exception.code == 403:
+    def __request_handle_http_errors(self, _id_, status: int, reason: str, body: bytes):
+        root_logger.error(f'HTTP Error {status}: {reason}')
+        if status == 403:
             # user blocked the bot
             # drop message
             return True     # Stop retrying
-        if exception.code == 414:
-            # Request-URI Too Large
-            root_logger.info(url)
+        if status in (400, 413):
+            # malformed or too large message, it will never be accepted
+            root_logger.info(body)
             # drop message
             return True
-        if exception.code == 429:
-            # too many requests
-            time.sleep(1)
+        if status == 429:
+            # too many requests, the next sending will wait as long as the server asked
+            parameters = self.feedback.get(_id_, {}).get('parameters') or {}
+            self._pause(_id_, parameters.get('retry_after', 1))
             return False
 
         # other unhandled codes
         return False
 
-    def _request(self, _id_, full_url):
-        """Return True if success or 403 or 414, otherwise False"""
+    def _request(self, _id_, body: bytes):
+        """Return True if success or 400, 403 or 413, otherwise False"""
+        self._acquire(_id_)
         try:
-            with request.urlopen(full_url) as fi:
-                data = fi.read()
-            self.feedback[_id_] = json.loads(data.decode())
-            return True
-        except json.JSONDecodeError as e:
-            self.feedback[_id_] = {'error': str(e), 'data': data}
-            return True
-        except error.HTTPError as e:
-            return self.__request_handle_http_errors(e, full_url)
-        except error.URLError as e:
-            time.sleep(1)
-            if "[Errno -2] Name or service not known" in e.reason:
-                root_logger.error(e)
-            return False
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+            response, data = self._post(_id_, self._send_path, body, headers)
         except ConnectionResetError as e:
             root_logger.info(e)
             return False
+        except (OSError, client.HTTPException) as e:
+            self._sleep(1)
+            if isinstance(e, socket.gaierror):
+                root_logger.error(e)
+            return False
         except Exception as e:
             root_logger.error(f"Unexpected error: {str(e)}")
             return False
 
+        try:
+            self.feedback[_id_] = json.loads(data.decode())
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            self.feedback[_id_] = {'error': str(e), 'data': data}
+
+        if 200 <= response.status < 300:
+            return True
+        return self.__request_handle_http_errors(_id_, response.status, response.reason, body)
+
 
-class TelegramHandler(logging.Handler, TelegramMixing):
+class JournalOutbox:
+    """Messages waiting to be sent, kept in an append-only journal file so that they survive a restart.
+
+        Each line of the file is a json object: an added message `{"id": 1, "to": destination, "text": text}`
+        or a sent one `{"done": 1}`. The file is compacted, rewritten with the pending messages only,
+        when most of its lines are sent messages or when it would grow over `max_size` bytes.
+        If the pending messages alone are over `max_size`, the oldest ones are dropped.
+    """
+    COMPACT_MIN_DONE = 1000     # don't rewrite the file for a few sent messages
+
+    def __init__(self, filename: str, max_size: int = 10 * 1024 * 1024):
+        self.filename = os.path.abspath(filename)
+        self.max_size = max_size
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()       # id: (destination, text, size of its line)
+        self._queues = defaultdict(deque)   # destination: ids in sending order
+        self._next_id = 1
+        self._done = 0
+        self._size = 0
+        self._file = None
+
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Replay the journal left by the previous run"""
+        if os.path.exists(self.filename):
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line could be cut by a crash
+                        continue
+
+                    if 'done' in entry:
+                        self._entries.pop(entry['done'], None)
+                    else:
+                        self._entries[entry['id']] = (entry['to'], entry['text'], len(line.encode()))
+                        self._next_id = max(self._next_id, entry['id'] + 1)
+
+        for entry_id, (destination, text, size) in self._entries.items():
+            self._queues[destination].append(entry_id)
+        self._compact()
+
+    def has_pending(self) -> bool:
+        return bool(self._entries)
+
+    def add(self, destination: str, text: str) -> int:
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            line = json.dumps({'id': entry_id, 'to': destination, 'text': text}, ensure_ascii=False) + '\n'
+            size = len(line.encode())
+            if self._size + size > self.max_size:
+                self._compact(size)
+
+            self._write(line, size)
+            self._entries[entry_id] = (destination, text, size)
+            self._queues[destination].append(entry_id)
+            return entry_id
+
+    def first(self, destination: str) -> Optional[tuple]:
+        """Return (id, text) of the oldest pending message of this destination"""
+        with self._lock:
+            queue = self._queues[destination]
+            while queue:
+                entry = self._entries.get(queue[0])
+                if entry:
+                    return queue[0], entry[1]
+                queue.popleft()     # dropped by compaction
+            return None
+
+    def done(self, entry_id: int):
+        """Mark the message as sent"""
+        with self._lock:
+            if self._entries.pop(entry_id, None) is None:
+                return
+
+            self._done += 1
+            if self._done >= self.COMPACT_MIN_DONE and self._done > len(self._entries):
+                self._compact()
+            else:
+                line = f'{{"done": {entry_id}}}\n'
+                self._write(line, len(line))
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _write(self, line: str, size: int):
+        if self._file is None:
+            self._file = open(self.filename, 'a', encoding='utf-8')
+        self._file.write(line)
+        self._file.flush()
+        self._size += size
+
+    def _compact(self, room: int = 0):
+        """Rewrite the journal with the pending messages only, keep `room` bytes free for the next line"""
+        total = sum(entry[2] for entry in self._entries.values())
+        while self._entries and total + room > self.max_size:
+            _, (destination, text, size) = self._entries.popitem(last=False)
+            total -= size
+            self.dropped += 1
+
+        if self._file:
+            self._file.close()
+            self._file = None
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry_id, (destination, text, size) in self._entries.items():
+                f.write(json.dumps({'id': entry_id, 'to': destination, 'text': text}, ensure_ascii=False) + '\n')
+        os.replace(tmp, self.filename)
+        self._size = total
+        self._done = 0
+
+
+class StormAggregator:
+    """Count the records of the same fingerprint (message template, logger name, line number) within a time window.
+        The first record of a fingerprint is let through, the following ones are summarized in a digest
+        at the end of each window. A fingerprint that stays quiet for a whole window is forgotten.
+        At most `max_size` fingerprints are tracked, the least recently seen one is summarized and dropped first.
+    """
+
+    def __init__(self, window: float, max_size: int = 1000):
+        self.window = window
+        self.max_size = max(1, max_size)
+        self._entries = OrderedDict()   # fingerprint: [window start, repeated count, last record]
+
+    @staticmethod
+    def fingerprint(record: logging.LogRecord) -> tuple:
+        return str(record.msg), record.name, record.lineno
+
+    def add(self, record: logging.LogRecord) -> list:
+        """Return the records to be sent now: the record itself if it is new, and the digest of an evicted one"""
+        key = self.fingerprint(record)
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+            entry[1] += 1
+            entry[2] = record
+            return []
+
+        out = []
+        now = time.monotonic()
+        if len(self._entries) >= self.max_size:
+            _, oldest = self._entries.popitem(last=False)
+            if oldest[1]:
+                out.append(self._digest(oldest, now))
+
+        self._entries[key] = [now, 0, record]
+        out.append(record)
+        return out
+
+    def sweep(self, force: bool = False) -> list:
+        """Return the digests of the windows that have ended, or of all windows if `force`"""
+        now = time.monotonic()
+        out = []
+        for key, entry in list(self._entries.items()):
+            if not force and now - entry[0] < self.window:
+                continue
+
+            if entry[1]:
+                out.append(self._digest(entry, now))
+                entry[0], entry[1] = now, 0
+            else:
+                del self._entries[key]
+        return out
+
+    @staticmethod
+    def _digest(entry: list, now: float) -> logging.LogRecord:
+        # the last record may be still waiting in the outbox, it must not be changed
+        start, count, record = entry
+        record = copy.copy(record)
+        record.remark = f'\n (Message repeated {count} times in {now - start:.0f}s)'
+        return record
+
+
+class TelegramHandler(TelegramMixing, logging.Handler):
+    """Send the log to Telegram chats.
+
+        `emit` only puts the record into the outbox, a bounded deque for each destination.
+        The HTTP requests, and the waiting on errors, are done by the delivery thread of this handler.
+        Call `flush()` to wait until the outbox is sent.
+    """
     LIMIT_LENGTH = 3072     # Telegram limits to 4096 chars, we set to around a half number
 
     def __init__(self, token='', unique_ids='', env_token_key='', env_unique_ids_key='',
-                 debug=False, check_interval=600, grouping_interval=0, push_interval=0):
+                 debug=False, check_interval=600, grouping_interval=0, push_interval=0, queue_size=100,
+                 base_url='https://api.telegram.org', rate_limit=30, chat_rate_limit=1, group_rate_limit=20 / 60,
+                 aggregate_window=0, aggregate_size=1000, outbox_file='', outbox_size=10 * 1024 * 1024,
+                 max_workers=4):
         """ Init telegram handler
 
         :param token: str, Telegram bot token
@@ -168,6 +1254,26 @@ class TelegramHandler(logging.Handler, TelegramMixing):
         :param grouping_interval: every log message has timestamp within this seconds
             will be grouped into one message before sending
         :param push_interval: how often the log should be sent out, min: 4 seconds
+        :param queue_size: max number of records waiting to be sent to each destination,
+            the oldest ones are dropped when it is full
+        :param base_url: str, url of the Bot API server. Change it to use a local Bot API server
+
+        For spreading the messages under the limits of Telegram, 0 means no limit:
+        :param rate_limit: max messages per second of the bot to all destinations
+        :param chat_rate_limit: max messages per second to each user chat
+        :param group_rate_limit: max messages per second to each group chat or topic
+
+        For collapsing repeated messages:
+        :param aggregate_window: a message that is repeated within this seconds is sent once,
+            then a digest with the number of repetitions is sent at the end of the window.
+            0: only collapse the same message logged consecutively
+        :param aggregate_size: max number of distinct messages to be counted at the same time
+
+        For keeping the unsent messages on disk:
+        :param outbox_file: path of the journal file of the unsent messages. They are sent after a restart.
+            Empty: keep them in memory, at most `queue_size` messages
+        :param outbox_size: max size of the journal file in bytes, the oldest messages are dropped first
+        :param max_workers: number of destinations to be sent to at the same time. 1: one after another
         """
         super().__init__()
 
@@ -185,36 +1291,79 @@ class TelegramHandler(logging.Handler, TelegramMixing):
 
         self._unique_ids = []       # type: list[str]
         self.set_unique_ids(unique_ids)
-        self.set_bot_token(token)
+        self.set_bot_token(token, base_url)
+        self.set_rate_limits(rate_limit, chat_rate_limit, group_rate_limit)
         self.feedback = {x: {} for x in self._unique_ids}
 
-        self.message_queue = {x: deque(maxlen=100) for x in self._unique_ids}
-        self.failed_messages = {x: deque(maxlen=100) for x in self._unique_ids}
+        self.message_queue = {x: deque(maxlen=queue_size) for x in self._unique_ids}
+        self.failed_messages = {x: deque(maxlen=queue_size) for x in self._unique_ids}
+        # with grouping_interval, the records taken out of message_queue to be grouped and sent
+        self.grouped_messages = {x: deque(maxlen=queue_size) for x in self._unique_ids}
+        # guards the hand-over of the queued items to the delivery thread, which never takes self.lock:
+        # logging.shutdown holds self.lock while it waits for the delivery in flush()
+        self._queue_lock = threading.Lock()
+
+        # all network I/O is done by the delivery thread, started on the first record
+        self._init_delivery(self._unique_ids, max_workers)
 
-        # background thread resends the log if network error previously
+        # formatted messages waiting to be sent, on disk
+        self.outbox = JournalOutbox(outbox_file, outbox_size) if outbox_file else None
+
+        # collapse the repeated messages of an error storm
+        self.aggregator = StormAggregator(aggregate_window, aggregate_size) if aggregate_window else None
+
+        # periodic works resend the log if network error previously
         self.debug = debug
         self.check_interval = check_interval
-        self._stop_event = Event()
-        self._init_threads()
+        self._tasks = []
+        self._init_tasks()
 
         # reduce sending duplicated log
         self.last_record = None
         self.last_message_hash = None
         self.dup_count = 0
 
-    def _init_threads(self):
-        watcher_thread = Thread(target=self.watcher, daemon=True)
-        watcher_thread.start()
+        if self.outbox is not None and self.outbox.has_pending():
+            # messages left by the previous run
+            self._wake_delivery()
+
+    def _init_tasks(self):
+        """Register the periodic works with the scheduler shared by all handlers"""
+        scheduler = get_scheduler()
+        if self.debug:
+            root_logger.debug(f'TelegramHandler watcher starts: {datetime.now()}')
+        self._tasks.append(scheduler.every(self.check_interval, self.watcher,
+                                           name=f'TelegramHandler watcher {id(self)}'))
+
         if self.grouping_interval:
-            pusher_thread = Thread(target=self.interval_pusher, daemon=True)
-            pusher_thread.start()
+            if self.debug:
+                root_logger.debug(f'TelegramHandler interval_pusher starts: {datetime.now()}')
+            self._tasks.append(scheduler.every(self.push_interval, self.interval_pusher,
+                                               name=f'TelegramHandler interval_pusher {id(self)}'))
+
+        if self.aggregator:
+            self._tasks.append(scheduler.every(min(1.0, self.aggregator.window), self.aggregate_sweeper,
+                                               name=f'TelegramHandler aggregate_sweeper {id(self)}'))
 
     def format(self, record):
         txt = super().format(record) + getattr(record, 'remark', '')
         return txt
 
     def close(self) -> None:
-        self._stop_event.set()
+        while self._tasks:
+            self._tasks.pop().cancel()
+
+        if self.aggregator:
+            # send out the counts so far
+            self.aggregate_sweeper(force=True)
+        self.flush()
+        self._stop_delivery()
+        super().close()
+
+    def _delivery_stopped(self):
+        super()._delivery_stopped()
+        if self.outbox is not None:
+            self.outbox.close()
 
     def set_unique_ids(self, ids):
         if not ids:
@@ -228,33 +1377,104 @@ class TelegramHandler(logging.Handler, TelegramMixing):
         else:
             raise TypeError(f'Expected str or int but got type: {type(ids)}')
 
+    def _chunks(self, text: str) -> list:
+        """Split a text that is too long for one message"""
+        return [text[x:x + self.LIMIT_LENGTH] for x in range(0, len(text), self.LIMIT_LENGTH)]
+
+    def _pack(self, texts: list) -> list:
+        """Join the texts, in order, into as few messages as possible.
+            A text is only split when it is too long to fit in one message alone.
+        """
+        messages = []
+        parts, size = [], -1
+        for text in texts:
+            if size + 1 + len(text) > self.LIMIT_LENGTH and parts:
+                messages.append('\n'.join(parts))
+                parts, size = [], -1
+
+            if len(text) > self.LIMIT_LENGTH:
+                messages.extend(self._chunks(text))
+            else:
+                parts.append(text)
+                size += 1 + len(text)
+
+        if parts:
+            messages.append('\n'.join(parts))
+        return messages
+
     def _send_request(self, _id_, msg_queue) -> bool:
+        """Send the queued items: records that are not formatted yet or formatted texts"""
         while msg_queue[_id_]:
-            record = msg_queue[_id_].popleft()
-            msg_out = self.format(record)
-            for x in range(0, len(msg_out), self.LIMIT_LENGTH):
-                chunk = msg_out[x:x + self.LIMIT_LENGTH]
-                full_url = self._build_message_url(_id_, chunk)
-                if not self._request(_id_, full_url):
-                    msg_queue[_id_].appendleft(record)
+            item = msg_queue[_id_].popleft()
+            text = self.format(item) if isinstance(item, logging.LogRecord) else item
+            chunks = self._chunks(text)
+            for i, chunk in enumerate(chunks):
+                body = self._build_message_body(_id_, chunk)
+                if not self._request(_id_, body):
+                    # keep the formatted text that has not been sent
+                    msg_queue[_id_].appendleft(''.join(chunks[i:]))
                     return False
         else:
             return True
 
-    def send(self):
-        for _id_ in self._unique_ids:
-            # try to resend failed msg
-            if not self._send_request(_id_, self.failed_messages):
-                # skip the current _id_
-                continue
+    def _journal_queued(self):
+        """Move the queued items into the outbox as formatted texts that fit in one message"""
+        queues = self.grouped_messages if self.grouping_interval else self.message_queue
+        with self._queue_lock:
+            for _id_ in self._unique_ids:
+                queue = queues[_id_]
+                while queue:
+                    item = queue.popleft()
+                    text = self.format(item) if isinstance(item, logging.LogRecord) else item
+                    for chunk in self._chunks(text):
+                        self.outbox.add(_id_, chunk)
 
-            # then send msg of this time
-            if not self._send_request(_id_, self.message_queue):
-                # cache to resend it later
-                failed_record = self.message_queue[_id_].popleft()
-                self.failed_messages[_id_].append(failed_record)
-                # skip the current _id_
-                continue
+    def _dispatch(self):
+        """Hand the cached records over to the delivery thread, unless they wait to be grouped"""
+        if self.grouping_interval:
+            # msg will be sent by self.interval_pusher
+            return
+
+        if self.outbox is not None:
+            # on disk right away, the memory queue never overflows during a long outage
+            self._journal_queued()
+        self._wake_delivery()
+
+    def _send_outbox(self, _id_):
+        while True:
+            # the queue is kept short while this thread waits for the network
+            self._journal_queued()
+            entry = self.outbox.first(_id_)
+            if entry is None:
+                break
+
+            entry_id, text = entry
+            if not self._request(_id_, self._build_message_body(_id_, text)):
+                # keep it in the outbox, the watcher will retry
+                break
+            self.outbox.done(entry_id)
+
+    def _send_to(self, _id_):
+        """Send everything of one destination, in order"""
+        if self.outbox is not None:
+            return self._send_outbox(_id_)
+
+        # try to resend failed msg
+        if not self._send_request(_id_, self.failed_messages):
+            return
+
+        # then send msg of this time
+        queues = self.grouped_messages if self.grouping_interval else self.message_queue
+        if not self._send_request(_id_, queues):
+            # cache to resend it later
+            failed_record = queues[_id_].popleft()
+            self.failed_messages[_id_].append(failed_record)
+
+    def send(self):
+        """Send to all destinations at the same time. A slow or failing one doesn't hold up the others"""
+        if self.grouping_interval:
+            self.msg_grouping()
+        self._fan_out(self._send_to, self._unique_ids)
 
     @staticmethod
     def _get_message_hash(record: logging.LogRecord) -> int:
@@ -279,7 +1499,24 @@ class TelegramHandler(logging.Handler, TelegramMixing):
             for _id_ in self._unique_ids:
                 self.message_queue[_id_].append(record)
 
+    def _repeated_record(self) -> logging.LogRecord:
+        """A copy of the last record that tells how many times it was repeated.
+            The original one may be still waiting in the outbox, it must not be changed.
+        """
+        record = copy.copy(self.last_record)
+        record.remark = f'\n (Message repeated {self.dup_count} times)'
+        return record
+
     def emit(self, record):
+        if self.aggregator:
+            with self.lock:
+                records = self.aggregator.add(record)
+                for x in records:
+                    self._cache_records(x)
+                if records:
+                    self._dispatch()
+            return
+
         with self.lock:
             # check and update hashing
             current_hash = self._get_message_hash(record)
@@ -293,71 +1530,279 @@ class TelegramHandler(logging.Handler, TelegramMixing):
             if self.dup_count:
                 # changed to a new record, no longer duplicated
                 # send last msg, then send this time msg
-                self.last_record.remark = f'\n (Message repeated {self.dup_count} times)'
-                self._cache_records(self.last_record)
+                self._cache_records(self._repeated_record())
 
             self.dup_count = 0
             self._cache_records(record)
             self.last_record = record
-            if self.grouping_interval:
-                # msg will be sent by self.interval_pusher
-                pass
-            else:
-                self.send()
+            self._dispatch()
 
     def msg_grouping(self):
+        """Format each record once and pack the ones in the same time window into as few messages as possible.
+            Texts that were grouped before are kept as they are.
+            Run by the delivery thread, the queue lock is only held to take the items and put the messages back.
+        """
         window_size = self.grouping_interval
+        # the same record is queued for every destination, its text is shared by all of them
+        texts_of = {}
 
         for _id_ in self._unique_ids:
+            queue = self.grouped_messages[_id_]
+            with self._queue_lock:
+                items = list(queue)
+                queue.clear()
+
+            messages = []
             group = defaultdict(list)
 
             # step 1: group message that are in the same time window
-            while self.message_queue[_id_]:
-                record = self.message_queue[_id_].popleft()
-                timestamp_window = record.created // window_size * window_size
-                group[timestamp_window].append(record)
+            for item in items:
+                if isinstance(item, logging.LogRecord):
+                    timestamp_window = item.created // window_size * window_size
+                    text = texts_of.get(id(item))
+                    if text is None:
+                        text = texts_of[id(item)] = self.format(item)
+                    group[timestamp_window].append(text)
+                else:
+                    messages.append(item)
+
+            # step 2: pack the lines of each window into messages
+            for grp, texts in sorted(group.items()):
+                messages.extend(self._pack(texts))
 
-            # step 2: append msg from all the following record into the first one
-            for grp, item in sorted(group.items()):
-                if len(item) > 1:
-                    following_msg = [self.format(x) for x in item[1:]]
-                    item[0].msg += '\n'.join(following_msg)
+            # then put the grouped messages back, before the records taken out meanwhile
+            with self._queue_lock:
+                queue.extendleft(reversed(messages))
 
-                # then flushes the grouped record back to queue
-                self.message_queue[_id_].append(item[0])
+    def _take_for_grouping(self) -> bool:
+        """Move the queued records to the ones to be grouped. Return True if there is something to send"""
+        with self.lock, self._queue_lock:
+            for _id_ in self._unique_ids:
+                queue = self.message_queue[_id_]
+                if queue:
+                    self.grouped_messages[_id_].extend(queue)
+                    queue.clear()
+            return (any(self.grouped_messages.values()) or any(self.failed_messages.values())
+                    or self.outbox is not None and self.outbox.has_pending())
 
     def interval_pusher(self):
-        if self.debug:
-            root_logger.debug(f'TelegramHandler interval_pusher starts: {datetime.now()}')
+        """Called by the scheduler every push_interval seconds.
+            It only hands the records over, the grouping and the sending are done by the delivery thread.
+        """
+        if self._take_for_grouping():
+            self._wake_delivery()
 
-        while not self._stop_event.is_set():
-            time.sleep(self.push_interval)
-            if any(self.message_queue.values()):
-                with self.lock:
-                    self.msg_grouping()
-                    self.send()
+    def aggregate_sweeper(self, force=False):
+        """Called by the scheduler to queue the digests of the ended aggregate windows"""
+        with self.lock:
+            digests = self.aggregator.sweep(force)
+            for record in digests:
+                self._cache_records(record)
+            if digests:
+                self._dispatch()
 
     def watcher(self):
         """
+        Called by the scheduler every check_interval seconds.
         This method will resend the failed messages if they haven't been sent in emit
         """
+        # the journaled messages are resent in every mode, the failed ones in memory go with the next group
+        if self.outbox is not None:
+            has_unsent = self.outbox.has_pending()
+        else:
+            has_unsent = any(self.failed_messages.values()) and not self.grouping_interval
+        if has_unsent:
+            if self.debug:
+                root_logger.debug(f'TelegramHandler found unsent messages: {datetime.now()}')
+            self._wake_delivery()
+
+        elif self.dup_count > 1:
+            if self.debug:
+                root_logger.debug(f'TelegramHandler watcher emit duplicated msg at: {datetime.now()}')
+            with self.lock:
+                self._cache_records(self._repeated_record())
+                self.dup_count = 0
+                self._dispatch()
+
+
+
+class WebhookHandler(HttpDeliveryMixing, logging.Handler):
+    """POST the log to an HTTP endpoint in batches, as a JSON array of records.
+
+        `emit` only formats the record into the queue. The delivery thread sends a batch when `batch_size`
+        records are queued or every `push_interval` seconds, through one kept-alive, optionally gzipped, connection.
+        A batch that failed is kept and sent again before the newer ones, so the order is preserved.
+    """
+
+    def __init__(self, url='', headers=None, batch_size=100, push_interval=1.0, queue_size=10000, compress=True,
+                 check_interval=30, rate_limit=0, aggregate_window=0, aggregate_size=1000, env_url_key='',
+                 debug=False):
+        """ Init webhook handler
+
+        :param url: str, http or https url that the batches are POSTed to
+        :param headers: dict, additional request headers, such as an "Authorization" header
+        :param batch_size: max number of records in one request
+        :param push_interval: send the queued records at least every this seconds
+        :param queue_size: max number of records waiting to be sent, the oldest ones are dropped when it is full
+        :param compress: bool, gzip the request body
+        :param check_interval: resend the failed batches every this seconds
+        :param rate_limit: max requests per second, 0: no limit
+        :param aggregate_window: a message that is repeated within this seconds is sent once,
+            then a digest with the number of repetitions is sent at the end of the window. 0: send all
+        :param aggregate_size: max number of distinct messages to be counted at the same time
+        :param env_url_key: str, environment variable name that holds the url
+        :param debug: bool, print additional log for testing
+        """
+        super().__init__()
+        if env_url_key:
+            url = os.environ.get(env_url_key, url)
+
+        self.url = url
+        self.set_base_url(url)
+        self._path = self._url.path or '/'
+        if self._url.query:
+            self._path += f'?{self._url.query}'
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+        if compress:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.compress = compress
+        self.set_buckets(rate_limit, {url: 0})
+
+        self.batch_size = max(1, batch_size)
+        self.queue = deque(maxlen=queue_size)
+        self.failed_batches = deque()   # the batch being sent, the next ones wait in the queue
+        self._send_partial = False      # the last records that are not a full batch are sent too
+        self._init_delivery([url])
+
+        # collapse the repeated messages of an error storm
+        self.aggregator = StormAggregator(aggregate_window, aggregate_size) if aggregate_window else None
+
+        self.debug = debug
+        self.push_interval = push_interval
+        self.check_interval = check_interval
+        self._tasks = []
+        self._init_tasks()
+
+    def _init_tasks(self):
+        """Register the periodic works with the scheduler shared by all handlers"""
+        scheduler = get_scheduler()
+        self._tasks.append(scheduler.every(self.push_interval, self.interval_pusher,
+                                           name=f'WebhookHandler interval_pusher {id(self)}'))
+        self._tasks.append(scheduler.every(self.check_interval, self.watcher,
+                                           name=f'WebhookHandler watcher {id(self)}'))
+        if self.aggregator:
+            self._tasks.append(scheduler.every(min(1.0, self.aggregator.window), self.aggregate_sweeper,
+                                               name=f'WebhookHandler aggregate_sweeper {id(self)}'))
+
+    def to_dict(self, record: logging.LogRecord) -> dict:
+        """One item of the JSON array. Override this to change the fields"""
+        return {
+            'created': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': self.format(record) + getattr(record, 'remark', ''),
+            'pathname': record.pathname,
+            'lineno': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+
+    def close(self) -> None:
+        while self._tasks:
+            self._tasks.pop().cancel()
+
+        if self.aggregator:
+            # send out the counts so far
+            self.aggregate_sweeper(force=True)
+        self.flush()
+        self._stop_delivery()
+        super().close()
+
+    def flush(self):
+        """Send the queue and wait until it is done, at most FLUSH_TIMEOUT seconds"""
+        if self.queue or self.failed_batches:
+            self._send_partial = True
+            self._wake_delivery()
+        super().flush()
+
+    def _queue(self, records: list):
+        self.queue.extend(self.to_dict(x) for x in records)
+        if len(self.queue) >= self.batch_size:
+            self._wake_delivery()
+
+    def emit(self, record):
+        try:
+            records = self.aggregator.add(record) if self.aggregator else [record]
+            self._queue(records)
+        except Exception:
+            self.handleError(record)
+
+    def _post_batch(self, batch: list):
+        """Return True if the batch is done with: sent, or rejected by the server.
+            Otherwise False and the seconds to wait before retrying, if the server told so.
+        """
+        body = json.dumps(batch, default=str).encode()
+        if self.compress:
+            body = gzip.compress(body, compresslevel=6)
+
+        self._acquire(self.url)
+        try:
+            response, data = self._post(self.url, self._path, body, self.headers)
+        except (OSError, client.HTTPException) as e:
+            root_logger.error(f'WebhookHandler: {e!r}')
+            return False, 0
+
+        if 200 <= response.status < 300:
+            return True, 0
+
+        root_logger.error(f'WebhookHandler HTTP Error {response.status}: {response.reason}')
+        if response.status in (408, 429) or response.status >= 500:
+            # worth retrying, wait as long as the server asked
+            try:
+                retry_after = float(response.getheader('Retry-After', 0))
+            except ValueError:
+                retry_after = 0
+            return False, retry_after
+
+        # other client errors, the batch will never be accepted
         if self.debug:
-            root_logger.debug(f'TelegramHandler watcher starts: {datetime.now()}')
+            root_logger.debug(data)
+        return True, 0
 
-        while not self._stop_event.is_set():
-            time.sleep(self.check_interval)
-            if any(self.failed_messages.values()) and not self.grouping_interval:
-                if self.debug:
-                    root_logger.debug(f'TelegramHandler found unsent messages: {datetime.now()}')
-                with self.lock:
-                    self.send()
+    def send(self):
+        """Send the failed batches first, then the queue, in batches of `batch_size` records"""
+        while True:
+            if self.failed_batches:
+                batch = self.failed_batches[0]
+            elif len(self.queue) >= self.batch_size or (self.queue and self._send_partial):
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self.failed_batches.append(batch)
+            else:
+                # the records queued while sending wait for a full batch or the next push
+                self._send_partial = False
+                return
 
-            elif self.dup_count > 1:
-                if self.debug:
-                    root_logger.debug(f'TelegramHandler watcher emit duplicated msg at: {datetime.now()}')
-                with self.lock:
-                    self.last_record.remark = f'\n (Message repeated {self.dup_count} times)'
-                    self._cache_records(self.last_record)
-                    self.send()
-                    self.dup_count = 0
+            done, retry_after = self._post_batch(batch)
+            if done:
+                self.failed_batches.popleft()
+            elif not (retry_after and self._sleep(retry_after)):
+                # the watcher will try again later
+                return
 
+    def interval_pusher(self):
+        """Called by the scheduler every push_interval seconds to send the records that are not a full batch"""
+        if self.queue:
+            self._send_partial = True
+            self._wake_delivery()
+
+    def aggregate_sweeper(self, force=False):
+        """Called by the scheduler to queue the digests of the ended aggregate windows"""
+        with self.lock:
+            self._queue(self.aggregator.sweep(force))
+
+    def watcher(self):
+        """Called by the scheduler every check_interval seconds to resend the failed batches"""
+        if self.failed_batches:
+            if self.debug:
+                root_logger.debug(f'WebhookHandler found unsent batches: {datetime.now()}')
+            self._wake_delivery()
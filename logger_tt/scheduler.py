@@ -0,0 +1,210 @@
+import os
+import sys
+import heapq
+import itertools
+import time
+import traceback
+from collections import deque
+from threading import Thread, Condition
+from typing import Callable, Optional
+
+__author__ = "Duc Tin"
+
+
+class ScheduledTask:
+    """A periodic job registered with the `Scheduler`, or a one-shot one if `interval` is 0.
+        Call `cancel()` to stop it, it will never run again after that.
+    """
+    __slots__ = ('func', 'interval', 'deadline', 'cancelled', 'name')
+
+    def __init__(self, func: Callable[[], None], interval: float, deadline: float, name: str = ''):
+        self.func = func
+        self.interval = interval
+        self.deadline = deadline
+        self.cancelled = False
+        self.name = name or getattr(func, '__qualname__', repr(func))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        if not self.interval:
+            return f'<ScheduledTask {self.name} once>'
+        return f'<ScheduledTask {self.name} every {self.interval}s>'
+
+
+class Scheduler:
+    """One thread that runs the periodic work of every handler in this process.
+
+        Tasks are kept in a heap of deadlines, the thread sleeps until the nearest one.
+        A task is rescheduled `interval` seconds after it finished running,
+        so a slow task never runs twice in a row to catch up.
+        Tasks should be short, blocking work (network, compression) belongs to its own worker.
+    """
+
+    def __init__(self, name: str = 'logger_tt scheduler'):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()   # tie-breaker for tasks with the same deadline
+        self._cond = Condition()
+        self._thread = None                 # type: Optional[Thread]
+        self._pid = None
+
+    def every(self, interval: float, func: Callable[[], None], name: str = '') -> ScheduledTask:
+        """Run `func` every `interval` seconds, the first run is `interval` seconds from now"""
+        if interval <= 0:
+            raise ValueError(f'"interval" must be a positive number, but got: {interval}')
+
+        task = ScheduledTask(func, interval, time.monotonic() + interval, name)
+        with self._cond:
+            self._push(task)
+            self._ensure_thread()
+            self._cond.notify()
+        return task
+
+    def after(self, delay: float, func: Callable[[], None], name: str = '') -> ScheduledTask:
+        """Run `func` once, `delay` seconds from now"""
+        task = ScheduledTask(func, 0, time.monotonic() + max(delay, 0), name)
+        with self._cond:
+            self._push(task)
+            self._ensure_thread()
+            self._cond.notify()
+        return task
+
+    def cancel(self, task: ScheduledTask):
+        """Cancel the task. It is removed from the heap lazily when its deadline comes."""
+        with self._cond:
+            task.cancel()
+            self._cond.notify()
+
+    @property
+    def tasks(self) -> list:
+        with self._cond:
+            return [entry[2] for entry in self._heap if not entry[2].cancelled]
+
+    def _after_fork_in_child(self):
+        # the tasks belong to the handlers of the parent, their copies in the child would flush
+        # or resend the parent's data a second time. The handlers made in the child register their own.
+        self._heap = []
+        # the lock could be held by the parent's thread at the moment of forking
+        self._cond = Condition()
+        self._thread = None
+
+    def _push(self, task: ScheduledTask):
+        heapq.heappush(self._heap, (task.deadline, next(self._counter), task))
+
+    def _ensure_thread(self):
+        # threads don't survive a fork, the child has to start its own one
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._thread = Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _next_task(self) -> Optional[ScheduledTask]:
+        """Block until a task is due and pop it out of the heap"""
+        with self._cond:
+            while True:
+                # drop cancelled tasks on top
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, _, task = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                return task
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            try:
+                task.func()
+            except Exception:
+                # never let a failing task kill the thread of all other tasks
+                if sys.stderr:
+                    sys.stderr.write(f'--- logger_tt scheduler: task {task.name} failed ---\n')
+                    traceback.print_exc(file=sys.stderr)
+
+            with self._cond:
+                if task.interval and not task.cancelled:
+                    task.deadline = time.monotonic() + task.interval
+                    self._push(task)
+
+
+class BackgroundWorker:
+    """One thread that runs the blocking jobs handed over by the handlers, one after another.
+        Handlers use it for work that must not pause the logging thread such as compressing files.
+    """
+
+    def __init__(self, name: str = 'logger_tt worker'):
+        self.name = name
+        self._jobs = deque()
+        self._running = 0
+        self._cond = Condition()
+        self._thread = None                 # type: Optional[Thread]
+        self._pid = None
+
+    def submit(self, func: Callable, *args):
+        with self._cond:
+            self._jobs.append((func, args))
+            if not (self._thread and self._thread.is_alive() and self._pid == os.getpid()):
+                self._pid = os.getpid()
+                self._thread = Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until all submitted jobs are done. Return False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._jobs and not self._running, timeout)
+
+    def _after_fork_in_child(self):
+        # the jobs belong to the parent, don't do them twice
+        self._jobs = deque()
+        self._cond = Condition()
+        self._thread = None
+        self._running = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._jobs)
+                func, args = self._jobs.popleft()
+                self._running = 1
+
+            try:
+                func(*args)
+            except Exception:
+                if sys.stderr:
+                    sys.stderr.write(f'--- logger_tt worker: job {func} failed ---\n')
+                    traceback.print_exc(file=sys.stderr)
+            finally:
+                with self._cond:
+                    self._running = 0
+                    self._cond.notify_all()
+
+
+_scheduler = Scheduler()
+_worker = BackgroundWorker()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_scheduler._after_fork_in_child)
+    os.register_at_fork(after_in_child=_worker._after_fork_in_child)
+
+
+def get_scheduler() -> Scheduler:
+    """Return the scheduler shared by all logger_tt handlers of this process"""
+    return _scheduler
+
+
+def get_background_worker() -> BackgroundWorker:
+    """Return the worker shared by all logger_tt handlers of this process"""
+    return _worker
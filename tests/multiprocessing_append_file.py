@@ -0,0 +1,33 @@
+import sys
+import multiprocessing
+
+from logger_tt import setup_logging
+from logging import getLogger
+
+
+__author__ = "Duc Tin"
+logger = getLogger(__name__)
+setup_logging(config_path="multiprocessing_append_config.json", use_multiprocessing=True)
+
+
+def worker(arg, line_no):
+    for i in range(line_no):
+        # lines of different length, up to about 3000 characters
+        logger.info(f'child {arg} line {i} ' + str(arg) * (i * 37 % 3000) + ' end')
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn')
+    proc_no, line_no = (int(x) for x in sys.argv[1:3])
+
+    all_processes = []
+    logger.info('Parent process is ready to spawn child')
+    for i in range(proc_no):
+        p = multiprocessing.Process(target=worker, args=(i, line_no))
+        all_processes.append(p)
+        p.start()
+
+    for p in all_processes:
+        p.join()
+
+    print('__finished__')
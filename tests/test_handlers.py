@@ -1,14 +1,26 @@
 import datetime
+import json
+import gzip
+import lzma
+import mmap
 import os
 import re
+import socket
+import threading
 import time
+import weakref
+import logging
+import logging.handlers
 
-from io import StringIO, BytesIO
-from logging import getLogger, DEBUG, Formatter
-from urllib import request, error as request_error
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from collections import deque
+from io import StringIO, BytesIO, TextIOWrapper
+from logging import getLogger, DEBUG, WARNING, Formatter, LogRecord
 
 import pytest
-from logger_tt.handlers import StreamHandlerWithBuffer, TelegramHandler, parse
+from logger_tt.handlers import StreamHandlerWithBuffer, BufferedRotatingFileHandler, LogArchiver, MMapFileHandler, \
+    TelegramHandler, JournalOutbox, WebhookHandler, AppendFileHandler, parse
 
 
 @pytest.mark.parametrize('threshold', [0.2, 0.4])
@@ -81,6 +93,73 @@ def test_handler_with_buffer_lines(caplog, threshold):
                 assert len(logs) == 2*threshold, "Total log lines should equal threshold * 2"
 
 
+@pytest.mark.parametrize('binary', [False, True])
+def test_handler_with_buffer_bytes(binary):
+    logger = getLogger(f'Test buffer bytes {binary}')
+    raw = BytesIO()
+    my_stream = TextIOWrapper(raw, encoding='utf8', write_through=True)
+    handler = StreamHandlerWithBuffer(stream=my_stream, buffer_time=0, buffer_lines=0,
+                                      buffer_bytes=100, binary=binary)
+    handler.setFormatter(Formatter(fmt="%(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+
+    line = 'x' * 19     # 20 bytes with the terminator
+    for i in range(4):
+        logger.info(line)
+    assert not raw.getvalue(), "Below buffer_bytes, nothing should be written"
+
+    logger.info(line)
+    assert raw.getvalue().decode('utf8') == (line + '\n') * 5, "Reaching buffer_bytes must flush all lines"
+
+    # a line longer than the whole buffer
+    long_line = 'y' * 1000 + ' ưư'
+    logger.info('before')
+    logger.info(long_line)
+    logger.info('after')
+    handler.export()
+    assert raw.getvalue().decode('utf8').splitlines()[-3:] == ['before', long_line, 'after']
+    logger.removeHandler(handler)
+
+
+def test_handler_with_buffer_binary_text_only_stream():
+    logger = getLogger('Test buffer binary StringIO')
+    my_stream = StringIO()
+    handler = StreamHandlerWithBuffer(stream=my_stream, buffer_time=0, buffer_lines=3, binary=True)
+    handler.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    for i in range(3):
+        logger.warning(f'line {i} ưư')
+    assert my_stream.getvalue().splitlines() == [f'WARNING: line {i} ưư' for i in range(3)]
+    logger.removeHandler(handler)
+
+
+@pytest.mark.parametrize('flush_level', ['ERROR', WARNING])
+def test_handler_with_buffer_flush_level(flush_level):
+    logger = getLogger(f'Test buffer flush level {flush_level}')
+    my_stream = StringIO()
+    handler = StreamHandlerWithBuffer(stream=my_stream, buffer_time=0, buffer_lines=100, flush_level=flush_level)
+    handler.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+
+    logger.debug('my debug')
+    logger.info('my info')
+    assert not my_stream.getvalue(), "Low level records must stay in the buffer"
+
+    logger.error('my error')
+    assert my_stream.getvalue().splitlines() == ['DEBUG: my debug', 'INFO: my info', 'ERROR: my error']
+
+    logger.info('left in buffer')
+    handler.close()
+    assert my_stream.getvalue().splitlines()[-1] == 'INFO: left in buffer', "close() must flush the buffer"
+    logger.removeHandler(handler)
+
+
 @pytest.mark.skip('comment this line. Add your bot token and chat_id/(group_id, topic) to test. Already tested!')
 @pytest.mark.parametrize('unique_id', ['123456789',
                                        '-1234567890123@2',
@@ -111,53 +190,102 @@ def test_telegram_handler_basic(unique_id):
         handler.close()
 
 
-def set_telegram_handler(log_name, bot_token='', user_id='123456789', **kwargs):
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep the connection alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        chat_id = parse.parse_qs(body.decode())['chat_id'][0]
+        time.sleep(self.server.delays.get(chat_id, 0))
+        self.server.received.append(body.decode())
+        self.server.times.append(time.monotonic())
+
+        status_code = self.server.status_code
+        if status_code == 200:
+            data = json.dumps({'ok': True}).encode()
+        else:
+            data = json.dumps({'ok': False, 'error_code': status_code, 'parameters': self.server.parameters}).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBotApi(ThreadingMixIn, HTTPServer):
+    """Local stand-in of the Telegram Bot API that records the posted bodies"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeBotApiHandler)
+        self.status_code = 200
+        self.parameters = {}
+        self.delays = {}    # chat_id: seconds to answer
+        self.received = []
+        self.times = []
+        self.connections = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    @property
+    def data(self):
+        return '\n\n'.join(self.received)
+
+
+@pytest.fixture
+def bot_api():
+    server = FakeBotApi()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def set_telegram_handler(log_name, bot_api: FakeBotApi, user_id='123456789', **kwargs):
+    # no rate limits unless the test asks for
+    for key in ['rate_limit', 'chat_rate_limit', 'group_rate_limit']:
+        kwargs.setdefault(key, 0)
+
     logger = getLogger(log_name)
-    handler = TelegramHandler(token=bot_token, unique_ids=user_id, debug=True, **kwargs)
+    handler = TelegramHandler(token='123:abc', unique_ids=user_id, debug=True, base_url=bot_api.url, **kwargs)
     formatter = Formatter(fmt="[%(asctime)s.%(msecs)03d] %(levelname)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
     handler.setFormatter(formatter)
+    logger.handlers.clear()
     logger.addHandler(handler)
     logger.propagate = False
     getLogger().setLevel(0)
     return logger, handler
 
 
-def mock_urlopen(status_code, url_snipping: StringIO):
-    # setup stub function
-
-    def fake_urlopen(url: str, *arg, **kwargs):
-        url_snipping.write(url + '\n\n')
-
-        if status_code != 200:
-            raise request_error.HTTPError('fake_url', code=status_code,
-                                          msg='fake_url raised error', hdrs={}, fp=None)
-        else:
-            my_stream = BytesIO()
-            my_stream.write(b'{"ok": "true"}')
-            my_stream.seek(0)
-            return my_stream
-
-    request.urlopen = fake_urlopen
-    # stub done
-
-
-def test_telegram_handler_error(caplog):
+def test_telegram_handler_error(caplog, bot_api):
     # setup handler
     user_id = '123456789'
-    logger, handler = set_telegram_handler('test telegram 0', user_id=user_id, check_interval=0.5)
+    logger, handler = set_telegram_handler('test telegram 0', bot_api, user_id=user_id, check_interval=0.5)
 
-    mock_urlopen(status_code=403, url_snipping=StringIO())
+    bot_api.status_code = 403
     logger.warning('user blocked this bot')
+    handler.flush()
     assert 'HTTP Error 403' in caplog.text
     assert not handler.message_queue[user_id]
     assert not handler.failed_messages[user_id]
 
-    mock_urlopen(status_code=500, url_snipping=StringIO())
+    bot_api.status_code = 500
     logger.error('server error')
+    handler.flush()
     assert not handler.message_queue[user_id]
     assert handler.failed_messages[user_id]
 
-    mock_urlopen(status_code=200, url_snipping=StringIO())
+    bot_api.status_code = 200
     for retry in range(2):
         try:
             time.sleep(1.5)
@@ -169,15 +297,132 @@ def test_telegram_handler_error(caplog):
         assert not handler.message_queue[user_id]
     assert 'HTTP Error 500' in caplog.text
     assert 'found unsent messages' in caplog.text
+    handler.close()
 
 
-def test_telegram_handler_repeated_msg_continuous(caplog):
-    # setup handler
-    logger, handler = set_telegram_handler('test telegram 1', check_interval=1)
+def test_telegram_handler_post_body(bot_api):
+    user_id = '-1234567890123@2'
+    logger, handler = set_telegram_handler('test telegram 6', bot_api, user_id=user_id)
+
+    # a long text is sent in the body, not in the url
+    for i in range(10):
+        logger.warning(f'message {i} ' + 'x' * 3000)
+    handler.flush()
+    handler.close()
+
+    assert len(bot_api.received) == 10
+    for body in bot_api.received:
+        params = parse.parse_qs(body)
+        assert params['chat_id'] == ['-1234567890123']
+        assert params['message_thread_id'] == ['2']
+        assert params['text'][0].endswith('x' * 3000)
+    assert bot_api.connections == 1, 'all messages must go through one kept-alive connection'
+
+
+def test_telegram_handler_reconnect(bot_api):
+    logger, handler = set_telegram_handler('test telegram 7', bot_api)
+
+    logger.warning('first message')
+    handler.flush()
+
+    # the server closes the idle connection
+    handler._connections['123456789'].sock.shutdown(socket.SHUT_RDWR)
+    logger.warning('second message')
+    handler.flush()
+    handler.close()
+
+    assert 'second+message' in bot_api.data
+    assert bot_api.connections == 2
+
+
+def test_telegram_handler_rate_limit(bot_api):
+    user_ids = '123456789; -1234567890123@2'
+    logger, handler = set_telegram_handler('test telegram 8', bot_api, user_id=user_ids,
+                                           chat_rate_limit=10, group_rate_limit=5)
+    for i in range(6):
+        logger.warning(f'incident {i}')
+    handler.flush()
+    handler.close()
+
+    user_times = [t for t, body in zip(bot_api.times, bot_api.received) if 'chat_id=123456789' in body]
+    group_times = [t for t, body in zip(bot_api.times, bot_api.received) if 'chat_id=-1234567890123' in body]
+    assert len(user_times) == len(group_times) == 6
+    assert min(b - a for a, b in zip(user_times, user_times[1:])) > 0.09
+    assert min(b - a for a, b in zip(group_times, group_times[1:])) > 0.19
+
+
+def test_telegram_handler_retry_after(caplog, bot_api):
+    user_id = '123456789'
+    logger, handler = set_telegram_handler('test telegram 9', bot_api, user_id=user_id, chat_rate_limit=100)
+
+    bot_api.status_code = 429
+    bot_api.parameters = {'retry_after': 1}
+    logger.warning('too many requests')
+    handler.flush()
+    assert 'HTTP Error 429' in caplog.text
+    assert handler.feedback[user_id]['parameters'] == {'retry_after': 1}
+
+    # the next message waits as long as the server asked
+    bot_api.status_code = 200
+    logger.warning('after waiting')
+    handler.flush()
+    handler.close()
+
+    assert 'after+waiting' in bot_api.received[-1]
+    assert bot_api.times[-1] - bot_api.times[0] >= 0.95
+
+
+def test_telegram_handler_resend_after_retry_after(bot_api):
+    user_id = '123456789'
+    logger, handler = set_telegram_handler('test telegram 15', bot_api, user_id=user_id, check_interval=600)
+
+    bot_api.status_code = 429
+    bot_api.parameters = {'retry_after': 1}
+    logger.warning('retried when the wait is over')
+    handler.flush()
+    assert handler.failed_messages[user_id]
+
+    # no more record and the watcher is far away, the message is still resent once the server allows
+    bot_api.status_code = 200
+    t0 = time.monotonic()
+    while handler.failed_messages[user_id] and time.monotonic() - t0 < 3:
+        time.sleep(0.05)
+    handler.close()
+
+    assert not handler.failed_messages[user_id]
+    assert 'retried+when' in bot_api.received[-1]
+    assert bot_api.times[-1] - bot_api.times[0] >= 0.95
+
+
+def test_telegram_handler_fan_out(bot_api):
+    user_ids = ['1001', '1002', '1003', '1004']
+    logger, handler = set_telegram_handler('test telegram 14', bot_api, user_id='; '.join(user_ids))
+    for chat_id in user_ids:
+        bot_api.delays[chat_id] = 0.3
+    bot_api.delays['1004'] = 1      # a slow chat
+
+    t0 = time.perf_counter()
+    for i in range(2):
+        logger.error(f'fan out {i}')
+    handler.flush()
+    dt = time.perf_counter() - t0
+    handler.close()
 
-    # setup
-    log_sent = StringIO()
-    mock_urlopen(status_code=200, url_snipping=log_sent)
+    assert dt < 3.2, 'one after another would take 3.8s'
+    for chat_id in user_ids:
+        texts = [x for x in bot_api.received if f'chat_id={chat_id}' in x]
+        assert ['fan+out+0' in texts[0], 'fan+out+1' in texts[1]] == [True, True], 'the order of each chat is kept'
+
+    healthy = handler.delivery_stats['1001']
+    assert healthy.sent == 2 and not healthy.failed
+    assert 0.3 <= healthy.avg < 1
+    assert handler.delivery_stats['1004'].max >= 1
+    assert bot_api.connections == 4, 'one connection per destination'
+
+
+def test_telegram_handler_repeated_msg_continuous(caplog, bot_api):
+    # setup handler
+    logger, handler = set_telegram_handler('test telegram 1', bot_api, check_interval=1)
 
     # run repeat the same message continuously
     for i in range(1000):
@@ -185,21 +430,17 @@ def test_telegram_handler_repeated_msg_continuous(caplog):
     time.sleep(2)   # let watcher run
 
     # check result
-    log_sent.seek(0)
-    data = log_sent.read()
+    data = bot_api.data
     count = data.count('Connection+error')
     assert count < 500
     res = re.findall(r'Message\+repeated\+(\d+)\+times', data)
     assert sum(int(x) for x in res) == 1000 - 1, data + '\n\n' + caplog.text
+    handler.close()
 
 
-def test_telegram_handler_repeated_msg_then_change(caplog):
+def test_telegram_handler_repeated_msg_then_change(caplog, bot_api):
     # setup handler
-    logger, handler = set_telegram_handler('test telegram 2', check_interval=1)
-
-    # setup
-    log_sent = StringIO()
-    mock_urlopen(status_code=200, url_snipping=log_sent)
+    logger, handler = set_telegram_handler('test telegram 2', bot_api, check_interval=1)
 
     # run repeat the same message for a while then different message
     for i in range(10):
@@ -209,8 +450,7 @@ def test_telegram_handler_repeated_msg_then_change(caplog):
     time.sleep(2)   # let watcher run
 
     # check result, watcher should have nothing to do
-    log_sent.seek(0)
-    data = log_sent.read()
+    data = bot_api.data
     count = data.count('Connection+error')
     assert 1 < count < 6, data + '\n\n' + caplog.text
     res = re.findall(r'Message\+repeated\+(\d+)\+times', data)
@@ -218,15 +458,160 @@ def test_telegram_handler_repeated_msg_then_change(caplog):
     assert sum(int(x) for x in res) == 10 - len(res), data + '\n\n' + caplog.text
     assert 'Memory+overflow' in data
     assert 'watcher emit duplicated' not in caplog.text
+    handler.close()
 
 
-def test_telegram_handler_grouping_msg_normal(caplog):
-    # setup handler
-    logger, handler = set_telegram_handler('test telegram 3', check_interval=10, grouping_interval=1)
+def test_telegram_handler_aggregate_alternating_msg(bot_api):
+    logger, handler = set_telegram_handler('test telegram 11', bot_api, aggregate_window=1)
+
+    # 2 errors alternate, the consecutive dedup could not collapse them
+    for i in range(100):
+        logger.error('Connection error: server %s', 500 + i)
+        logger.error('Database is locked')
+    handler.flush()
+
+    assert len(bot_api.received) == 2, 'only the first occurrences are sent immediately'
+    time.sleep(2.5)     # let the windows end
+
+    data = bot_api.data
+    assert len(bot_api.received) == 4, data
+    res = re.findall(r'Message\+repeated\+(\d+)\+times\+in\+(\d+)s', data)
+    assert sorted(int(x) for x, _ in res) == [99, 99]
+    assert 'server+599' in data, 'the digest shows the last occurrence'
+
+    # the windows were quiet, the next occurrence is sent immediately again
+    time.sleep(1.5)
+    logger.error('Database is locked')
+    handler.flush()
+    assert len(bot_api.received) == 5
+    handler.close()
+
+
+def test_telegram_handler_aggregate_size(bot_api):
+    logger, handler = set_telegram_handler('test telegram 12', bot_api, aggregate_window=60, aggregate_size=2)
+
+    for i in range(3):
+        for _ in range(2):
+            logger.error('error A')
+        logger.error('error B')
+        logger.error('error C')
+        assert len(handler.aggregator._entries) <= 2
+    handler.flush()
+    handler.close()
 
-    # setup
-    log_sent = StringIO()
-    mock_urlopen(status_code=200, url_snipping=log_sent)
+    # each new error evicts the least recently seen one with a digest of its counts
+    data = bot_api.data
+    assert sum(int(x) for x in re.findall(r'Message\+repeated\+(\d+)\+times', data)) == 3
+    assert len(bot_api.received) == 12, 'A, B, C of each round and a digest of A'
+    assert data.count('error+A') == 6
+
+
+def test_telegram_handler_outbox_survives_restart(tmp_path, bot_api):
+    user_id = '123456789'
+    outbox_file = tmp_path / 'outbox' / 'telegram.jsonl'
+    logger, handler = set_telegram_handler('test telegram 13', bot_api, user_id=user_id, outbox_file=str(outbox_file))
+
+    # network is down, more messages than the memory queue can hold
+    bot_api.status_code = 500
+    handler.message_queue[user_id] = deque(maxlen=5)
+    for i in range(20):
+        logger.error(f'outage {i} ' + 'z' * (4000 if i == 3 else 0))
+    handler.flush()
+    handler.close()
+    logger.removeHandler(handler)
+    assert outbox_file.exists()
+
+    # restart, the messages are replayed in order
+    bot_api.status_code = 200
+    bot_api.received.clear()
+    logger, handler = set_telegram_handler('test telegram 13', bot_api, user_id=user_id, outbox_file=str(outbox_file))
+    handler.flush()
+    handler.close()
+
+    sent = [parse.parse_qs(body)['text'][0] for body in bot_api.received]
+    assert len(sent) == 21, 'the long message is sent in 2 chunks'
+    assert [int(re.search(r'outage (\d+)', x).group(1)) for x in sent if 'outage' in x] == list(range(20))
+    assert not handler.outbox.has_pending()
+
+
+def test_telegram_handler_outbox_logging_shutdown(tmp_path, bot_api):
+    user_id = '123456789'
+    outbox_file = tmp_path / 'outbox' / 'telegram.jsonl'
+    logger, handler = set_telegram_handler('test telegram 16', bot_api, user_id=user_id, outbox_file=str(outbox_file))
+    bot_api.delays[user_id] = 0.1
+    for i in range(5):
+        logger.error(f'before exit {i}')
+
+    # logging.shutdown holds the handler lock while it flushes and closes the handler
+    t0 = time.monotonic()
+    logging.shutdown([weakref.ref(handler)])
+    assert time.monotonic() - t0 < 3, 'the delivery thread must not wait for the handler lock'
+    logger.removeHandler(handler)
+
+    assert not handler.outbox.has_pending()
+    assert [parse.parse_qs(body)['text'][0][-1] for body in bot_api.received] == list('01234')
+
+
+def test_telegram_handler_outbox_with_grouping_retries(tmp_path, bot_api):
+    user_id = '123456789'
+    outbox_file = tmp_path / 'outbox' / 'telegram.jsonl'
+    logger, handler = set_telegram_handler('test telegram 17', bot_api, user_id=user_id, outbox_file=str(outbox_file),
+                                           grouping_interval=1, push_interval=0.2, check_interval=0.5)
+    bot_api.status_code = 500
+    logger.error('sent after the outage')
+    t0 = time.monotonic()
+    while not bot_api.received and time.monotonic() - t0 < 3:
+        time.sleep(0.05)
+    handler.flush()
+    assert handler.outbox.has_pending()
+
+    # no new record, the journaled message is still resent once the network is back
+    bot_api.status_code = 200
+    t0 = time.monotonic()
+    while handler.outbox.has_pending() and time.monotonic() - t0 < 3:
+        time.sleep(0.05)
+    handler.close()
+
+    assert not handler.outbox.has_pending()
+    assert 'sent+after+the+outage' in bot_api.received[-1] and len(bot_api.received) >= 2
+
+
+def test_journal_outbox_compaction_and_size(tmp_path):
+    filename = tmp_path / 'outbox.jsonl'
+    outbox = JournalOutbox(str(filename), max_size=4000)
+
+    ids = [outbox.add('123', f'message {i:03d} ' + 'x' * 80) for i in range(100)]
+    assert filename.stat().st_size <= 4000
+    assert outbox.dropped > 50, 'the oldest messages are dropped to keep the size'
+
+    # the newest messages are kept
+    entry_id, text = outbox.first('123')
+    assert entry_id == ids[outbox.dropped]
+    for entry_id in ids[outbox.dropped:]:
+        outbox.done(entry_id)
+    assert outbox.first('123') is None
+    outbox.close()
+
+    # a crash cut the last line, the journal is still readable
+    with filename.open('a') as f:
+        f.write('{"id": 1000, "to": "123", "text": "fir')
+    outbox = JournalOutbox(str(filename), max_size=4000)
+    assert not outbox.has_pending()
+
+    JournalOutbox.COMPACT_MIN_DONE = 10
+    try:
+        for i in range(30):
+            outbox.done(outbox.add('123', f'sent {i}'))
+        size = filename.stat().st_size
+        assert size < 1000, 'the sent messages are removed from the journal'
+    finally:
+        JournalOutbox.COMPACT_MIN_DONE = 1000
+        outbox.close()
+
+
+def test_telegram_handler_grouping_msg_normal(caplog, bot_api):
+    # setup handler
+    logger, handler = set_telegram_handler('test telegram 3', bot_api, check_interval=10, grouping_interval=1)
 
     # run repeat the same message for a while then different message
     for i in range(10):
@@ -243,19 +628,13 @@ def test_telegram_handler_grouping_msg_normal(caplog):
         
     time.sleep(4)   # let watcher run
 
-    log_sent.seek(0)
-    data = log_sent.read()
-    count = data.count('https')
-    assert count == 3, 'There should be 3 groups of http request'
+    assert len(bot_api.received) == 3, 'There should be 3 groups of http request'
+    handler.close()
 
 
-def test_telegram_handler_grouping_msg_resend(caplog):
+def test_telegram_handler_grouping_msg_resend(caplog, bot_api):
     # setup handler
-    logger, handler = set_telegram_handler('test telegram 4', check_interval=10, grouping_interval=1)
-
-    # setup
-    log_sent = StringIO()
-    mock_urlopen(status_code=200, url_snipping=log_sent)
+    logger, handler = set_telegram_handler('test telegram 4', bot_api, check_interval=10, grouping_interval=1)
 
     # run repeat the same message for a while then different message
     for i in range(100):
@@ -267,8 +646,465 @@ def test_telegram_handler_grouping_msg_resend(caplog):
     # second sent
     time.sleep(6)  # let watcher run
 
-    log_sent.seek(0)
-    data = log_sent.read()
-    count = data.count('%0A')
-    assert count == 98, 'Grouped message should not be regrouped again'
-    assert data.count('https:') > 1, 'long message should be divided'
+    data = bot_api.data
+    for i in range(100):
+        assert data.count(f'+Retry+{i}+time') == 1, 'Grouped message should not be regrouped again'
+    assert len(bot_api.received) > 1, 'long message should be divided'
+    assert data.count('%0A') == 100 - len(bot_api.received), 'a line must not be split into 2 messages'
+    handler.close()
+
+
+def test_telegram_handler_grouping_packs_lines(bot_api):
+    logger, handler = set_telegram_handler('test telegram 10', bot_api)
+    handler.grouping_interval = 60
+    now = time.time()
+
+    records = [LogRecord(logger.name, WARNING, __file__, 1, f'line {i} ' + 'x' * 1000, None, None)
+               for i in range(6)]
+    long_record = LogRecord(logger.name, WARNING, __file__, 1, 'long ' + 'y' * 5000, None, None)
+    for record in records[:3] + [long_record] + records[3:]:
+        record.created = now
+        handler._cache_records(record)
+
+    handler._take_for_grouping()
+    handler.msg_grouping()
+    messages = list(handler.grouped_messages['123456789'])
+    assert all(isinstance(x, str) for x in messages), 'records are formatted when grouped'
+    assert all(len(x) <= handler.LIMIT_LENGTH for x in messages)
+    assert [x.count('line') for x in messages] == [2, 1, 0, 0, 2, 1], 'lines are packed in order'
+    assert messages[2].count('y') + messages[3].count('y') == 5000, 'only the long record is split'
+
+    handler.msg_grouping()
+    assert list(handler.grouped_messages['123456789']) == messages, 'grouped texts are not grouped again'
+
+    handler._wake_delivery()
+    handler.flush()
+    handler.close()
+    assert len(bot_api.received) == 6
+    assert ''.join(bot_api.received).count('line+') == 6
+
+
+def test_telegram_handler_grouping_formats_once(bot_api):
+    user_ids = ['1001', '1002']
+    logger, handler = set_telegram_handler('test telegram 18', bot_api, user_id='; '.join(user_ids))
+    handler.grouping_interval = 60
+    formatted = []
+
+    class CountingFormatter(logging.Formatter):
+        def format(self, record):
+            formatted.append(record)
+            return super().format(record)
+
+    handler.setFormatter(CountingFormatter('%(message)s'))
+    for i in range(3):
+        handler._cache_records(LogRecord(logger.name, WARNING, __file__, 1, f'line {i}', None, None))
+
+    handler._take_for_grouping()
+    handler.msg_grouping()
+    assert len(formatted) == 3, 'each record is formatted once for all destinations'
+    for user_id in user_ids:
+        assert list(handler.grouped_messages[user_id]) == ['line 0\nline 1\nline 2']
+
+    handler.close()
+
+
+def test_telegram_handler_emit_does_not_wait_for_network(bot_api):
+    user_id = '123456789'
+    logger, handler = set_telegram_handler('test telegram 5', bot_api, user_id=user_id)
+
+    released = threading.Event()
+    original_post = handler._post
+
+    def slow_post(*args):
+        released.wait(5)
+        return original_post(*args)
+
+    handler._post = slow_post
+    try:
+        t0 = time.perf_counter()
+        for i in range(5):
+            logger.warning(f'slow network {i}')
+        assert time.perf_counter() - t0 < 1, 'emit must not wait for the HTTP request'
+        assert not bot_api.received
+    finally:
+        released.set()
+
+    handler.flush()
+    assert bot_api.data.count('slow+network') == 5
+    assert not handler.message_queue[user_id]
+    handler.close()
+
+
+def test_telegram_handler_slow_push_does_not_hold_scheduler(bot_api):
+    user_id = '123456789'
+    logger, handler = set_telegram_handler('test telegram 11', bot_api, user_id=user_id,
+                                           check_interval=60, grouping_interval=1, push_interval=0.2)
+    bot_api.delays[user_id] = 2
+    stream = StringIO()
+    buffered = StreamHandlerWithBuffer(stream=stream, buffer_time=0.2, buffer_lines=0)
+    try:
+        logger.warning('first, sent slowly')
+        time.sleep(0.5)     # the delivery thread is now waiting for the slow server
+        logger.warning('second, grouped while the first is being sent')
+        time.sleep(0.3)     # the next interval_pusher runs meanwhile
+
+        buffered.handle(LogRecord('other', WARNING, __file__, 1, 'timed flush', None, None))
+        t0 = time.monotonic()
+        while 'timed flush' not in stream.getvalue() and time.monotonic() - t0 < 3:
+            time.sleep(0.05)
+        assert time.monotonic() - t0 < 1, 'the timed flush of another handler must not wait for Telegram'
+    finally:
+        buffered.close()
+        bot_api.delays.clear()
+        handler.flush()
+        handler.close()
+    assert bot_api.data.count('sent+slowly') == 1
+
+
+def set_rotating_handler(log_name, filename, **kwargs):
+    logger = getLogger(log_name)
+    handler = BufferedRotatingFileHandler(filename, encoding='utf8', **kwargs)
+    handler.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+    return logger, handler
+
+
+class FakeWebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep the connection alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        status_code = self.server.status_codes.popleft() if self.server.status_codes else 200
+        if status_code == 200:
+            self.server.received.append(json.loads(body.decode()))
+        self.server.times.append(time.monotonic())
+
+        self.send_response(status_code)
+        if status_code != 200:
+            self.send_header('Retry-After', '0.3')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWebhook(ThreadingMixIn, HTTPServer):
+    """Local stand-in of a log collector that records the posted batches"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeWebhookHandler)
+        self.status_codes = deque()     # answers of the next requests, then 200
+        self.received = []
+        self.times = []
+        self.connections = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/logs?source=test'
+
+
+@pytest.fixture
+def webhook():
+    server = FakeWebhook()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def set_webhook_handler(log_name, webhook: FakeWebhook, **kwargs):
+    logger = getLogger(log_name)
+    handler = WebhookHandler(url=webhook.url, **kwargs)
+    handler.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.handlers.clear()
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+    return logger, handler
+
+
+def test_webhook_handler_batches(webhook):
+    logger, handler = set_webhook_handler('test webhook 0', webhook, batch_size=10, push_interval=60)
+    for i in range(25):
+        logger.info(f'record {i}')
+    handler.flush()
+
+    assert [len(batch) for batch in webhook.received] == [10, 10, 5]
+    assert webhook.connections == 1, 'all batches go through one kept-alive connection'
+    record = webhook.received[0][0]
+    assert record['message'] == 'INFO: record 0'
+    assert record['level'] == 'INFO'
+    assert record['logger'] == 'test webhook 0'
+    assert record['lineno'] and record['created']
+    assert handler.delivery_stats[handler.url].sent == 3
+    handler.close()
+
+
+def test_webhook_handler_retry_after(webhook):
+    logger, handler = set_webhook_handler('test webhook 1', webhook, batch_size=2, push_interval=60)
+    webhook.status_codes.extend([503])
+    for i in range(5):
+        logger.info(f'record {i}')
+    handler.flush()
+
+    messages = [x['message'] for batch in webhook.received for x in batch]
+    assert messages == [f'INFO: record {i}' for i in range(5)], 'the failed batch is sent again, in order'
+    assert webhook.times[1] - webhook.times[0] >= 0.3, 'Retry-After is honored'
+    assert handler.delivery_stats[handler.url].failed == 1
+    handler.close()
+
+
+def test_webhook_handler_drops_rejected_batch(webhook):
+    logger, handler = set_webhook_handler('test webhook 2', webhook, batch_size=2, push_interval=60, compress=False)
+    webhook.status_codes.extend([400])
+    for i in range(4):
+        logger.info(f'record {i}')
+    handler.flush()
+
+    assert [x['message'] for batch in webhook.received for x in batch] == ['INFO: record 2', 'INFO: record 3']
+    assert not handler.failed_batches
+    handler.close()
+
+
+def test_buffered_rotating_file_handler_by_size(tmp_path):
+    log_file = tmp_path / 'log.txt'
+    logger, handler = set_rotating_handler('test rotating size', log_file, maxBytes=1000, backupCount=3,
+                                           buffer_time=0, buffer_lines=7)
+
+    for i in range(200):
+        logger.info(f'line {i:03d}')        # 15 bytes per line
+        if i == 5:
+            assert not log_file.read_text(), 'lines must be cached until buffer_lines is reached'
+    handler.close()
+    logger.removeHandler(handler)
+
+    files = sorted(tmp_path.iterdir())
+    assert len(files) == 4, 'the active file and 3 backups'
+    assert all(f.stat().st_size <= 1000 for f in files)
+
+    lines = log_file.read_text(encoding='utf8').splitlines()
+    assert lines[-1] == 'INFO: line 199'
+    assert 1000 - 15 < sum(f.stat().st_size for f in files if f != log_file) / 3 <= 1000
+
+
+def test_buffered_rotating_file_handler_by_time(tmp_path):
+    log_file = tmp_path / 'log.txt'
+    logger, handler = set_rotating_handler('test rotating time', log_file, when='midnight',
+                                           buffer_time=0, buffer_lines=100)
+    rollover_at = handler.rolloverAt
+    assert rollover_at == datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1),
+                                                    datetime.time()).timestamp()
+
+    logger.info('today')
+    logger.info('still today')
+    handler.rolloverAt = time.time()    # pretend that midnight has come
+    logger.info('tomorrow')
+    handler.flush()
+
+    rotated = [f for f in tmp_path.iterdir() if f != log_file]
+    assert len(rotated) == 1
+    assert rotated[0].name == f'log.txt.{datetime.date.today():%Y-%m-%d}'
+    assert rotated[0].read_text().splitlines() == ['INFO: today', 'INFO: still today']
+    assert log_file.read_text().splitlines() == ['INFO: tomorrow']
+    assert handler.rolloverAt == rollover_at, 'the next rollover is the coming midnight again'
+    handler.close()
+    logger.removeHandler(handler)
+
+
+def test_buffered_rotating_file_handler_flush_level(tmp_path):
+    log_file = tmp_path / 'log.txt'
+    logger, handler = set_rotating_handler('test rotating level', log_file, buffer_time=0.2, buffer_lines=0)
+
+    logger.info('my info')
+    assert not log_file.read_text()
+
+    logger.error('my error')
+    assert log_file.read_text().splitlines() == ['INFO: my info', 'ERROR: my error']
+
+    logger.debug('my debug')
+    time.sleep(0.5)
+    assert log_file.read_text().splitlines()[-1] == 'DEBUG: my debug', 'buffer_time must flush the cache'
+    handler.close()
+    logger.removeHandler(handler)
+
+
+@pytest.mark.parametrize('compress, opener', [('gzip', gzip.open), ('lzma', lzma.open)])
+def test_buffered_rotating_file_handler_compress(tmp_path, compress, opener):
+    log_file = tmp_path / 'log.txt'
+    logger, handler = set_rotating_handler(f'test rotating {compress}', log_file, maxBytes=1000, backupCount=2,
+                                           compress=compress, buffer_time=0, buffer_lines=1)
+
+    for i in range(200):
+        logger.info(f'line {i:03d}')        # 15 bytes per line
+    handler.close()
+    logger.removeHandler(handler)
+
+    rotated = sorted((f for f in tmp_path.iterdir() if f != log_file), key=lambda f: f.stat().st_mtime_ns)
+    assert len(rotated) == 2
+    assert all(f.name.endswith(handler.archiver.extension) for f in rotated)
+    with opener(rotated[-1], 'rt') as fi:
+        lines = fi.read().splitlines()
+    last_line = int(lines[-1].split()[-1])
+    assert log_file.read_text().splitlines()[0] == f'INFO: line {last_line + 1:03d}'
+
+
+def test_log_archiver_retention(tmp_path):
+    source = tmp_path / 'log.txt'
+    now = time.time()
+    for day in range(10):
+        rotated = tmp_path / f'log.txt.2024-01-{day + 1:02d}'
+        rotated.write_text('x' * 100)
+        mtime = now - (10 - day) * 24 * 3600
+        os.utime(rotated, (mtime, mtime))
+    (tmp_path / 'other.txt').write_text('not a log file')
+
+    LogArchiver('', max_age_days=7.5).apply_retention(str(source))
+    assert len(list(tmp_path.glob('log.txt.*'))) == 7
+
+    LogArchiver('', max_total_size=550).apply_retention(str(source))
+    assert len(list(tmp_path.glob('log.txt.*'))) == 5
+
+    LogArchiver('', backup_count=3).apply_retention(str(source))
+    assert sorted(f.name for f in tmp_path.glob('log.txt.*')) == ['log.txt.2024-01-08', 'log.txt.2024-01-09',
+                                                                  'log.txt.2024-01-10']
+    assert (tmp_path / 'other.txt').exists()
+
+
+def test_log_archiver_runs_in_background(tmp_path):
+    source = tmp_path / 'log.txt'
+    source.write_text('my log line\n' * 100000)
+    archiver = LogArchiver('gzip', backup_count=1)
+    archiver(str(source), str(tmp_path / 'log.txt.1'))
+    assert not source.exists(), 'source must be moved away at once'
+
+    assert archiver.join(timeout=5)
+    assert [f.name for f in tmp_path.iterdir()] == ['log.txt.1.gz']
+    with gzip.open(tmp_path / 'log.txt.1.gz', 'rt') as fi:
+        assert fi.read() == 'my log line\n' * 100000
+
+
+def test_log_archiver_stdlib_timed_handler(tmp_path):
+    log_file = tmp_path / 'app.log'
+    handler = logging.handlers.TimedRotatingFileHandler(log_file, when='H', encoding='utf8')
+    handler.rotator = LogArchiver('gzip', backup_count=2)
+    handler.setFormatter(Formatter('%(message)s'))
+    for i in range(4):
+        handler.handle(LogRecord('app', WARNING, __file__, 10, f'hour {i}', None, None))
+        handler.rolloverAt = 1700000000 + (i + 1) * 3600    # each file is named after its own hour
+        handler.doRollover()
+    assert handler.rotator.join(timeout=5)
+    handler.close()
+
+    rotated = sorted(f for f in tmp_path.iterdir() if f != log_file)
+    assert [f.suffix for f in rotated] == ['.gz', '.gz'], 'every kept file is compressed'
+    assert [gzip.open(f, 'rt').read() for f in rotated] == ['hour 2\n', 'hour 3\n']
+
+
+def test_mmap_file_handler(tmp_path):
+    log_file = tmp_path / 'log.txt'
+    logger = getLogger('test mmap handler')
+    handler = MMapFileHandler(log_file, segment_size=64 * 1024)
+    handler.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+
+    for i in range(100):
+        logger.info(f'line {i:03d} ưư')
+    logger.info('contains \0 NUL')
+
+    # the file is preallocated, valid data ends at the first NUL byte
+    data = log_file.read_bytes()
+    assert len(data) == 64 * 1024
+    lines = data[:data.index(b'\0')].decode('utf8').splitlines()
+    assert lines[0] == 'INFO: line 000 ưư'
+    assert lines[-1] == 'INFO: contains \\x00 NUL'
+
+    # simulate a crash: the handler is not closed, a new one continues after the valid data
+    logger.removeHandler(handler)
+    handler2 = MMapFileHandler(log_file, segment_size=64 * 1024)
+    handler2.setFormatter(Formatter(fmt="%(levelname)s: %(message)s"))
+    logger.addHandler(handler2)
+    logger.info('after restart')
+    handler2.close()
+    logger.removeHandler(handler2)
+
+    lines = log_file.read_text(encoding='utf8').splitlines()
+    assert len(lines) == 102
+    assert lines[-1] == 'INFO: after restart'
+    assert '\0' not in log_file.read_text(encoding='utf8'), 'close() must cut off the unused part'
+
+
+def test_mmap_file_handler_rollover(tmp_path):
+    log_file = tmp_path / 'log.txt'
+    logger = getLogger('test mmap handler rollover')
+    handler = MMapFileHandler(log_file, segment_size=mmap.ALLOCATIONGRANULARITY, backupCount=2)
+    handler.setFormatter(Formatter(fmt="%(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(DEBUG)
+
+    line = 'x' * 99
+    n_lines = mmap.ALLOCATIONGRANULARITY // 100
+    for i in range(3 * n_lines + 1):
+        logger.info(line)
+    logger.info('y' * 3 * mmap.ALLOCATIONGRANULARITY)    # longer than a segment
+    logger.info('last line')
+    handler.close()
+    logger.removeHandler(handler)
+
+    rotated = sorted((f for f in tmp_path.iterdir() if f != log_file), key=lambda f: f.stat().st_mtime_ns)
+    assert len(rotated) == 2, 'only backupCount files are kept'
+    assert rotated[0].read_text() == line + '\n', '3 full segments then the last x line'
+    assert rotated[1].read_text() == 'y' * 3 * mmap.ALLOCATIONGRANULARITY + '\n', 'a long line has its own segment'
+    assert log_file.read_text() == 'last line\n'
+
+
+class ShortWriter(BytesIO):
+    """A file that takes at most 5 bytes per write call"""
+    def write(self, data):
+        return super().write(bytes(data[:5]))
+
+
+@pytest.mark.parametrize('make_handler', [
+    lambda path: StreamHandlerWithBuffer(stream=open(path, 'w'), buffer_time=0, buffer_lines=0, buffer_bytes=40,
+                                         binary=True),
+    lambda path: BufferedRotatingFileHandler(path, buffer_time=0, buffer_bytes=40),
+    lambda path: AppendFileHandler(path, buffer_lines=0, atomic_size=40),
+])
+def test_buffer_overflow_line_is_flushed_on_close(tmp_path, make_handler):
+    log_file = tmp_path / 'log.txt'
+    handler = make_handler(log_file)
+    handler.setFormatter(Formatter('%(message)s'))
+    lines = [f'line {i:03d} xxxxx' for i in range(3)]     # 15 bytes each, the third one overflows the buffer
+    for line in lines:
+        handler.handle(LogRecord('app', WARNING, __file__, 10, line, None, None))
+
+    handler.close()
+    if isinstance(handler, StreamHandlerWithBuffer):
+        handler.stream.close()
+    assert log_file.read_text().splitlines() == lines, 'the line that started a new buffer must not be lost'
+
+
+def test_append_file_handler_short_write(tmp_path):
+    handler = AppendFileHandler(tmp_path / 'log.txt', delay=True)
+    handler.setFormatter(Formatter('%(message)s'))
+    handler.stream = ShortWriter()
+    for i in range(3):
+        handler.handle(LogRecord('app', WARNING, __file__, 10, 'line number %d', (i,), None))
+
+    assert handler.stream.getvalue() == b'line number 0\nline number 1\nline number 2\n'
+    handler.stream = None
+    handler.close()
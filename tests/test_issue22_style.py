@@ -1,8 +1,17 @@
 import re
+import sys
+import copy
+import time
+import pickle
 import pytest
+from io import StringIO
+from string import Template
+from logging import LogRecord, ERROR, Formatter, StreamHandler
+from logging.handlers import SocketHandler
 from pathlib import Path
 from tests.utils import config_modified
-from logger_tt import getLogger, setup_logging, logger as my_logger
+from logger_tt import getLogger, setup_logging, lazy, logger as my_logger
+from logger_tt.enhanced_class import DefaultFormatter, DefaultLogRecord, compile_format
 
 
 __author__ = "Duc Tin"
@@ -63,3 +72,206 @@ def test_style_dollar(capsys, this_logger):
         log_data = log.read_text()
         assert re.search(r'test_issue22_style:\d+ CRITICAL hello2 world', log_data)
         assert re.search(r'test_issue22_style:\d+ CRITICAL hello3 beautiful world', log_data)
+
+
+@pytest.mark.parametrize("style, fmt", [
+    ('%', '[%(asctime)s] [%(name)s:%(lineno)d %(levelname)s] %(message)s 100%%'),
+    ('%', '%(levelname)-8s %(lineno)5.1f %(message)r'),
+    ('{', '[{asctime}] {name}:{lineno:>5d} {levelname!r} {message} {{x}}'),
+    ('$', '[${asctime}] $name:$lineno ${levelname} $message 5% $$'),
+])
+def test_compiled_format(monkeypatch, style, fmt):
+    monkeypatch.setattr(DefaultFormatter, 'default_formats', dict(DefaultFormatter.default_formats))
+    stdlib = DefaultFormatter(fmt, datefmt='%Y-%m-%d %H:%M:%S', style=style)
+    compiled = DefaultFormatter(fmt, datefmt='%Y-%m-%d %H:%M:%S', style=style, compiled=True)
+    assert compiled._compiled, 'every default format can be compiled'
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        exc_info = sys.exc_info()
+
+    for name, thread_name, exc in [('app', 'MainThread', None), ('logger_tt', 'MainThread', None),
+                                   ('logger_tt', 'Thread-1', None), ('app', 'MainThread', exc_info)]:
+        record = LogRecord(name, ERROR, __file__, 10, 'hello world', None, exc)
+        record.threadName = thread_name
+        assert compiled.format(copy.copy(record)) == stdlib.format(copy.copy(record))
+
+
+def test_compiled_format_fallback():
+    formatter = DefaultFormatter('%(levelname)s %s', compiled=True)
+    assert formatter._compiled is None, 'positional placeholders are left to the stdlib'
+    assert compile_format('{name.upper}', '{') is None
+    assert compile_format('$name $', '$') is None
+
+
+def test_compiled_format_from_config(capsys):
+    with config_modified(
+            'style_brace_config.yaml',
+            [('logger_tt/compiled_format', True),
+             ('formatters/simple/style', '{'),
+             ('formatters/simple/format', '[{asctime}] {name}:{lineno} {levelname} {message}'),
+             ('formatters/brief/style', '{'),
+             ('formatters/brief/format', '[{asctime}] {levelname} {message}')
+             ]):
+
+        with setup_logging(config_path='style_brace_config.yaml') as config:
+            normal_logger.critical("hello1 {}", "world")
+            assert all(h.formatter._compiled for h in config.root_handlers)
+
+        assert 'CRITICAL hello1 world' in capsys.readouterr().out
+        assert re.search(r'test_issue22_style:\d+ CRITICAL hello1 world', log.read_text())
+
+
+def test_compiled_format_argument(capsys):
+    with setup_logging(compiled_format=True) as config:
+        normal_logger.critical("hello2 %s", "world")
+        assert config.root_handlers and all(h.formatter._compiled for h in config.root_handlers)
+
+    assert 'CRITICAL: hello2 world' in capsys.readouterr().out
+
+    with setup_logging() as config:
+        assert not any(h.formatter._compiled for h in config.root_handlers), 'off by default'
+
+
+@pytest.mark.parametrize("datefmt", ['%Y-%m-%d %H:%M:%S', None, '%H:%M:%S %Z'])
+def test_cached_time(datefmt):
+    cached = DefaultFormatter('[%(asctime)s] %(message)s', datefmt=datefmt)
+    stdlib = Formatter('[%(asctime)s] %(message)s', datefmt=datefmt)
+    for created in [1700000000.0, 1700000000.25, 1700000000.999, 1700000001.5, 1700000000.5]:
+        record = LogRecord('app', ERROR, __file__, 10, 'hello', None, None)
+        record.created, record.msecs = created, (created - int(created)) * 1000
+        assert cached.format(record) == stdlib.format(record)
+
+
+@pytest.mark.skipif(not hasattr(time, 'tzset'), reason='time.tzset() is only available on Unix')
+def test_cached_time_zone_change(monkeypatch):
+    formatter = DefaultFormatter('%(asctime)s', datefmt='%Y-%m-%d %H:%M:%S %Z')
+
+    def make_record(created):
+        record = LogRecord('app', ERROR, __file__, 10, 'hello', None, None)
+        record.created = created
+        return record
+
+    try:
+        monkeypatch.setenv('TZ', 'UTC')
+        time.tzset()
+        assert formatter.format(make_record(1688169600.0)) == '2023-07-01 00:00:00 UTC'
+
+        monkeypatch.setenv('TZ', 'America/New_York')
+        time.tzset()
+        assert formatter.format(make_record(1688169600.0)) == '2023-06-30 20:00:00 EDT', \
+            'the same second in a new time zone'
+        assert formatter.format(make_record(1704067200.0)) == '2023-12-31 19:00:00 EST', \
+            'daylight saving time has ended'
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+class CountingLogRecord(LogRecord):
+    calls = 0
+
+    def getMessage(self):
+        CountingLogRecord.calls += 1
+        return super().getMessage()
+
+
+def test_format_once_per_record():
+    formatter = DefaultFormatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    streams = [StringIO(), StringIO(), StringIO()]
+    logger = getLogger('test format once')
+    logger.propagate = False
+    logger.handlers.clear()
+    for stream in streams:
+        handler = StreamHandler(stream)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    CountingLogRecord.calls = 0
+    record = CountingLogRecord('test format once', ERROR, __file__, 10, 'hello %s', ('world',), None)
+    logger.handle(record)
+    assert CountingLogRecord.calls == 1, 'a record fanned out to 3 handlers is formatted once'
+    assert len({stream.getvalue() for stream in streams}) == 1
+
+    # a modified or a copied record is formatted again
+    record.msg = 'bye %s'
+    assert formatter.format(record).endswith('ERROR: bye world')
+    assert formatter.format(copy.copy(record)).endswith('ERROR: bye world')
+    assert CountingLogRecord.calls == 3
+    logger.handlers.clear()
+
+
+@pytest.mark.parametrize("msg", ['hello ${who}, 100% of $what $$5', 'no placeholder', '$who$what'])
+def test_cached_dollar_message(msg):
+    kwargs = dict(who='world', what=('a', 'tuple'))
+    for _ in range(2):
+        record = DefaultLogRecord('app', ERROR, __file__, 10, msg, None, None, **kwargs)
+        assert record.get_message_dollar() == Template(msg).substitute(kwargs)
+
+
+def test_cached_dollar_message_errors():
+    record = DefaultLogRecord('app', ERROR, __file__, 10, 'hello $who', None, None, other=1)
+    with pytest.raises(KeyError):
+        record.get_message_dollar()
+
+    record = DefaultLogRecord('app', ERROR, __file__, 10, 'costs $5', None, None, who=1)
+    with pytest.raises(ValueError):
+        record.get_message_dollar()
+
+
+class Costly:
+    calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        return value
+
+
+@pytest.mark.parametrize("method, msg, args, kwargs", [
+    ('get_message_percent', 'hello %s, %.1f', (lazy(str, 'world'), lazy(float, 2)), {}),
+    ('get_message_percent', 'hello %(who)s', ({'who': lazy(str, 'world')},), {}),
+    ('get_message_brace', 'hello {}, {num:.1f}', (lazy(str, 'world'),), {'num': lazy(float, 2)}),
+    ('get_message_dollar', 'hello $who', (), {'who': lazy(str, 'world')}),
+])
+def test_lazy_args(method, msg, args, kwargs):
+    record = DefaultLogRecord('app', ERROR, __file__, 10, msg, args, None, **kwargs)
+    assert getattr(record, method)().startswith('hello world')
+
+
+def test_lazy_args_evaluated_once(capsys):
+    costly = Costly()
+    with config_modified(
+            'lazy_args_config.yaml',
+            [('handlers/error_file_handler/level', 'INFO'),
+             ('formatters/simple/style', '{'),
+             ('formatters/simple/format', '[{asctime}] {name}:{lineno} {levelname} {message}'),
+             ('formatters/brief/style', '{'),
+             ('formatters/brief/format', '{levelname}: {message}')
+             ]):
+
+        with setup_logging(config_path='lazy_args_config.yaml'):
+            logger = getLogger('test lazy args')
+            logger.debug('dropped {}', lazy(costly, 1))
+            assert costly.calls == 0, 'a record that no handler takes is not formatted by the queue'
+
+            logger.info('taken {} {value}', lazy(costly, 1), value=lazy(costly, 2))
+
+    assert costly.calls == 2, 'once for all handlers'
+    assert 'INFO: taken 1 2' in capsys.readouterr().out
+    assert 'INFO taken 1 2' in log.read_text() and 'dropped' not in log.read_text()
+
+    # the value is kept on the record: formatted again or sent away without a new call
+    formatter = DefaultFormatter('{levelname}: {message}', style='{')
+    record = DefaultLogRecord('app', ERROR, __file__, 10, 'sent {value}', (), None, value=lazy(costly, 3))
+    assert formatter.format(record) == 'ERROR: sent 3'
+    assert formatter.format(copy.copy(record)) == 'ERROR: sent 3'
+    fields = pickle.loads(SocketHandler('localhost', None).makePickle(record)[4:])
+    assert fields['msg'] == 'sent 3' and fields['kwargs'] == {'value': 3}
+    assert costly.calls == 3
+
+
+def test_lazy_pickle():
+    value = lazy(Costly(), [1, 2])
+    assert pickle.loads(pickle.dumps(value)) == [1, 2]
+    assert f'{lazy(float, 2):.2f}' == '2.00' and str(value) == '[1, 2]'
@@ -0,0 +1,112 @@
+import sys
+import json
+import logging
+import logging.handlers
+import pytest
+from pathlib import Path
+from tests.utils import config_modified
+from logger_tt import getLogger, setup_logging, lazy, logger as my_logger
+from logger_tt.enhanced_class import JsonFormatter, DefaultLogRecord, orjson
+
+
+__author__ = "Duc Tin"
+log = Path.cwd() / 'logs/log.txt'
+normal_logger = getLogger(__name__)
+
+JSON_FORMATTER = {'()': 'logger_tt.enhanced_class.JsonFormatter', 'datefmt': '%Y-%m-%d %H:%M:%S'}
+
+
+def read_log() -> list:
+    lines = log.read_text().splitlines()
+    return [json.loads(line) for line in lines if line.startswith('{')]
+
+
+def test_json_formatter_fields():
+    record = DefaultLogRecord('app', logging.WARNING, __file__, 10, 'hello %s', ('world',), None, user='bob')
+    record.dest_name = 'admin'
+    data = json.loads(JsonFormatter(style='%').format(record))
+
+    assert list(data) == ['time', 'level', 'logger', 'message', 'pathname', 'lineno', 'function',
+                          'process', 'thread', 'kwargs', 'extra']
+    assert data['message'] == 'hello world' and data['level'] == 'WARNING' and data['lineno'] == 10
+    assert data['kwargs'] == {'user': 'bob'}
+    assert data['extra'] == {'dest_name': 'admin'}, 'the attributes that a context injector adds'
+
+    layout = {'msg': 'message', 'at': 'created', 'who': 'kwargs', 'exc': 'exception'}
+    data = json.loads(JsonFormatter(fields=layout).format(record))
+    assert data == {'msg': 'hello world', 'at': record.created, 'who': {'user': 'bob'}}
+
+
+@pytest.mark.parametrize("encoder", ['json', 'orjson'])
+def test_json_formatter_encoders(encoder):
+    if encoder == 'orjson' and orjson is None:
+        pytest.skip('orjson is not installed')
+
+    record = DefaultLogRecord('app', logging.INFO, __file__, 10, 'café %s', (object,), None,
+                              path=Path('a'), ids={1: 'one'})
+    text = JsonFormatter(encoder=encoder, style='%').format(record)
+    assert '\n' not in text and 'café' in text
+    data = json.loads(text)
+    assert data['kwargs'] == {'path': 'a', 'ids': {'1': 'one'}}, 'unknown types are written as text'
+
+    with pytest.raises(ValueError):
+        JsonFormatter(encoder='pickle')
+
+
+def test_json_formatter_exception():
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record = logging.LogRecord('app', logging.ERROR, __file__, 10, 'failed', (), sys.exc_info())
+
+    data = json.loads(JsonFormatter().format(record))
+    assert data['message'] == 'failed'
+    assert data['exception'].startswith('Traceback') and 'ZeroDivisionError' in data['exception']
+
+
+def test_json_formatter_analyzed_exception_once():
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record = logging.LogRecord('app', logging.ERROR, __file__, 10, 'failed\nanalyzed ZeroDivisionError', (),
+                                   sys.exc_info())
+    record.exc_analysis = 'analyzed ZeroDivisionError'
+    queued = logging.handlers.QueueHandler(None).prepare(record)
+    assert 'Traceback' in queued.msg, 'the queue adds the traceback after the analysis'
+
+    for this_record in [record, queued]:
+        text = JsonFormatter().format(this_record)
+        data = json.loads(text)
+        assert data['message'] == 'failed' and data['exception'] == 'analyzed ZeroDivisionError'
+        assert text.count('ZeroDivisionError') == 1, 'the exception is written in one field only'
+
+
+def test_json_formatter_extra_order():
+    record = DefaultLogRecord('app', logging.INFO, __file__, 10, 'hello', (), None)
+    for key in ['zone', 'request_id', 'attempt', 'user', 'b']:
+        setattr(record, key, key)
+    data = json.loads(JsonFormatter().format(record))
+    assert list(data['extra']) == ['zone', 'request_id', 'attempt', 'user', 'b'], 'in the order they were added'
+
+
+@pytest.mark.parametrize("this_logger", [my_logger, normal_logger])
+def test_json_formatter_setup(capsys, this_logger):
+    with config_modified('json_formatter_config.yaml',
+                         [('formatters/json', JSON_FORMATTER),
+                          ('handlers/error_file_handler/formatter', 'json')]):
+        with setup_logging(config_path='json_formatter_config.yaml') as config:
+            config.set_context_injector(lambda record: setattr(record, 'request_id', 'abc') or True)
+            this_logger.info('hello {who}', who=lazy(str, 'world'))
+            try:
+                1 / 0
+            except ZeroDivisionError as e:
+                this_logger.exception(e)
+
+    assert 'hello' in capsys.readouterr().out, 'the other handlers keep their text format'
+    records = read_log()
+    info = next(x for x in records if x['message'].startswith('hello'))
+    assert info['level'] == 'INFO' and info['extra'] == {'request_id': 'abc'}
+
+    error = next(x for x in records if x['level'] == 'ERROR')
+    assert error['message'] == 'division by zero', 'the analyzed exception is not repeated in the message'
+    assert 'ZeroDivisionError' in error['exception'] and '1 / 0' in error['exception']
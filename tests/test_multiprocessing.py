@@ -185,3 +185,23 @@ def test_multiprocessing_issue21_timeout5sec():
 
         # this time there are some more log from the other processes
         assert 'worker complete' in data
+
+
+def test_multiprocessing_append_file_handler():
+    append_handler = {'class': 'logger_tt.handlers.AppendFileHandler', 'level': 'DEBUG', 'formatter': 'simple',
+                      'filename': 'logs/log.txt', 'encoding': 'utf8'}
+    with config_modified("multiprocessing_append_config.json", [('handlers/error_file_handler', append_handler)]):
+        cmd = [sys.executable, "multiprocessing_append_file.py", "6", "300"]
+        result = run(cmd, stdout=PIPE, universal_newlines=True)
+        assert '__finished__' in result.stdout
+
+    # every process writes to the file directly, lines never interleave nor duplicate
+    lines = log.read_text(encoding='utf8').splitlines()
+    assert any('Parent process is ready to spawn child' in line for line in lines)
+    child_lines = [line for line in lines if re.search(r'child \d+ line', line)]
+    assert len(child_lines) == 6 * 300
+    for line in child_lines:
+        match = re.search(r'child (\d+) line (\d+) (\d*) end$', line)
+        assert match, line
+        proc, i, filling = match.groups()
+        assert filling == proc * (int(i) * 37 % 3000)
@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+import time
+import pytest
+from io import StringIO
+
+from logger_tt.scheduler import Scheduler, get_scheduler
+from logger_tt.handlers import StreamHandlerWithBuffer
+
+
+__author__ = "Duc Tin"
+
+
+def test_scheduler_runs_tasks_in_deadline_order():
+    scheduler = Scheduler('test scheduler')
+    calls = []
+    slow = scheduler.every(0.3, lambda: calls.append('slow'))
+    fast = scheduler.every(0.1, lambda: calls.append('fast'))
+
+    time.sleep(0.45)
+    slow.cancel()
+    fast.cancel()
+
+    assert calls.count('fast') >= 3
+    assert calls.count('slow') == 1
+    assert calls.index('slow') > 1, 'the slow task must run after the fast one'
+
+
+def test_scheduler_cancel():
+    scheduler = Scheduler('test scheduler')
+    calls = []
+    task = scheduler.every(0.05, lambda: calls.append(1))
+    time.sleep(0.2)
+    scheduler.cancel(task)
+    count = len(calls)
+
+    time.sleep(0.2)
+    assert count, 'task must have run before cancelled'
+    assert len(calls) == count, 'cancelled task must not run anymore'
+    assert task not in scheduler.tasks
+
+
+def test_scheduler_runs_once():
+    scheduler = Scheduler('test scheduler')
+    calls = []
+    task = scheduler.after(0.1, lambda: calls.append(1))
+    cancelled = scheduler.after(0.1, lambda: calls.append(2))
+    cancelled.cancel()
+
+    time.sleep(0.4)
+    assert calls == [1]
+    assert task not in scheduler.tasks
+
+
+def test_scheduler_survives_failing_task(capsys):
+    scheduler = Scheduler('test scheduler')
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ValueError('my failing task')
+
+    task = scheduler.every(0.05, failing)
+    time.sleep(0.2)
+    task.cancel()
+
+    assert len(calls) > 1, 'a failing task is still rescheduled'
+    assert 'my failing task' in capsys.readouterr().err
+
+
+def test_buffered_handlers_share_one_thread():
+    thread_count = threading.active_count()
+    handlers = [StreamHandlerWithBuffer(stream=StringIO(), buffer_time=0.1, buffer_lines=0) for _ in range(20)]
+    assert threading.active_count() <= thread_count + 1
+
+    scheduler = get_scheduler()
+    for handler in handlers:
+        assert handler._flush_task in scheduler.tasks
+        handler.close()
+        assert handler._flush_task not in scheduler.tasks
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_scheduler_in_forked_child(tmp_path):
+    parent_file, child_file = tmp_path / 'parent.txt', tmp_path / 'child.txt'
+    stream = open(parent_file, 'w')
+    handler = StreamHandlerWithBuffer(stream=stream, buffer_time=0.2, buffer_lines=0)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.handle(logging.makeLogRecord({'msg': 'buffered in the parent'}))
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            # the tasks of the parent's handlers are dropped, a handler of the child has its own timed flush
+            with open(child_file, 'w') as child_stream:
+                child_handler = StreamHandlerWithBuffer(stream=child_stream, buffer_time=0.2, buffer_lines=0)
+                child_handler.handle(logging.makeLogRecord({'msg': 'from the child'}))
+                time.sleep(1)
+                code = 0 if 'from the child' in child_file.read_text() else 2
+        finally:
+            os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    handler.close()
+    stream.close()
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, 'the child line was not flushed in time'
+    assert parent_file.read_text().count('buffered in the parent') == 1, 'the child must not flush the parent data'
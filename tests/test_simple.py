@@ -8,6 +8,8 @@ from io import StringIO
 
 import pytest
 from logger_tt import setup_logging, logging_disabled, logger as my_logger, remove_unused_handlers
+from logger_tt.enhanced_class import ModuleIndex
+from tests.utils import config_modified
 
 
 __author__ = "Duc Tin"
@@ -189,6 +191,94 @@ def test_default_logger_suppress():
     assert len(re.findall(r"tests.sub_module:\d+ INFO", log_data)) == 0
 
 
+def test_default_logger_unknown_path():
+    # code that has no module, such as a script run by exec(), keeps its file name
+    code = compile("from logger_tt import logger\nlogger.info('from exec')", '/nowhere/exec_script.py', 'exec')
+    with setup_logging():
+        exec(code, {})
+
+    log_data = log.read_text()
+    assert re.search(r"exec_script.py:2 INFO.+from exec", log_data)
+
+
+def test_module_index(tmp_path, monkeypatch):
+    index = ModuleIndex()
+    assert index.get(__file__.replace('\\', '/')) == __name__
+
+    missing = (tmp_path / 'late_module.py').as_posix()
+    assert index.get(missing) is None
+    updates = []
+    monkeypatch.setattr(index, '_update', lambda: updates.append(1))
+    assert index.get(missing) is None
+    assert not updates, 'a path without module is not searched again until more modules are imported'
+    monkeypatch.undo()
+
+    (tmp_path / 'late_module.py').write_text('x = 1\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import late_module
+    assert index.get(Path(late_module.__file__).as_posix()) == 'late_module'
+    del sys.modules['late_module']
+
+
+class RecordList(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def log_from_helper(logger):
+    logger.info('from helper')
+
+
+@pytest.mark.parametrize('cache_size', [1024, 0])
+def test_call_site_cache(cache_size):
+    with setup_logging(call_site_cache_size=cache_size):
+        logger = getLogger('test call site')
+        handler = RecordList()
+        logger.addHandler(handler)
+        for i in range(2):
+            logger.info('loop')
+            log_from_helper(logger)
+        logger.info('with stack', stack_info=True)
+        logger.removeHandler(handler)
+
+    first_line = test_call_site_cache.__code__.co_firstlineno
+    lines = [x.lineno - first_line for x in handler.records]
+    helper_line = log_from_helper.__code__.co_firstlineno + 1
+    assert lines == [7, helper_line - first_line, 7, helper_line - first_line, 9], 'a cached call site has the same line'
+    assert {x.pathname for x in handler.records} == {__file__}
+    assert [x.funcName for x in handler.records] == ['test_call_site_cache', 'log_from_helper'] * 2 + ['test_call_site_cache']
+    assert 'test_call_site_cache' in handler.records[-1].stack_info
+
+
+def test_handler_level_filter(capsys):
+    with config_modified('handler_level_filter.yaml', [('handlers/error_file_handler/level', 'INFO')]):
+        with setup_logging(config_path='handler_level_filter.yaml', handler_level_filter=True) as config:
+            this_logger = getLogger('test handler level')
+            assert not this_logger.isEnabledFor(logging.DEBUG), 'no handler behind the queue takes DEBUG'
+            assert this_logger.isEnabledFor(logging.INFO)
+            this_logger.debug('rejected debug')
+            this_logger.info('taken info')
+
+            # a handler level changed on the fly
+            file_handler = next(h for h in config.q_listeners[0].handlers if isinstance(h, logging.FileHandler))
+            file_handler.setLevel(logging.DEBUG)
+            assert not this_logger.isEnabledFor(logging.DEBUG), 'cached'
+            config.refresh_handler_levels()
+            assert this_logger.isEnabledFor(logging.DEBUG)
+
+            file_handler.setLevel(logging.INFO)
+            config.handler_level_filter = False
+            assert this_logger.isEnabledFor(logging.DEBUG)
+
+    log_data = log.read_text()
+    assert 'taken info' in log_data and 'rejected debug' not in log_data
+    assert 'taken info' in capsys.readouterr().out
+
+
 def test_double_setup_logging():
     # there should be a warning if setup_logging() is called multiple times
     with setup_logging() as log_config: